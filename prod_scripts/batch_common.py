@@ -0,0 +1,104 @@
+from opportunity_store import upsert
+from catalog_store import STORE_FILE, select_ids, item_prefix
+from price_cache import negative_key, mark_negative, clear_negative, get_suppressed
+
+# -sw/-sh/-col are shorthands for these item_id prefixes
+PREFIX_FLAGS = {"-sw": "sw", "-sh": "sh", "-col": "col"}
+# IDs that start like a prefix but belong to another theme, e.g. "shell" minifigs aren't super heroes
+EXCLUDED_PREFIXES = {"sh": ["shell"]}
+
+
+def select_scope(argv):
+    """
+    Returns the (prefix, category) to scan for the flags in argv: -sw/-sh/-col,
+    or any ID prefix or category id with --prefix=njo / --category=65.
+    """
+    prefix = category = None
+    for arg in argv:
+        if arg in PREFIX_FLAGS:
+            prefix = PREFIX_FLAGS[arg]
+        elif arg.startswith("--prefix="):
+            prefix = arg.split("=", 1)[1]
+        elif arg.startswith("--category="):
+            category = arg.split("=", 1)[1]
+    return prefix, category
+
+
+def select_category(argv):
+    """
+    Returns the scan category label for the flags in argv: the prefix
+    ("sw", "sh", "col", ...), "cat<id>" for a category, both joined by "_",
+    or "all".
+    """
+    prefix, category = select_scope(argv)
+    parts = ([prefix] if prefix else []) + ([f"cat{category}"] if category else [])
+    return "_".join(parts) or "all"
+
+
+def load_minifig_ids(argv):
+    """
+    Loads the minifigs to scan for the flags in argv from the catalog store,
+    leaving out ones marked for deletion. Raises RuntimeError if none match.
+    """
+    prefix, category = select_scope(argv)
+    minifig_ids = select_ids(prefix, category, exclude_prefixes=EXCLUDED_PREFIXES.get(prefix, []))
+    if not minifig_ids:
+        raise RuntimeError(f"No minifigs in {STORE_FILE} match {select_category(argv)}. "
+                           f"Run test_scripts/extract_catalog.py to fill the catalog.")
+    return minifig_ids
+
+
+def shard_ids(minifig_ids, shards, by="range"):
+    """
+    Splits minifig_ids into `shards` lists for separate worker processes:
+    contiguous ranges of catalog order ("range"), or whole ID prefixes
+    balanced by size ("prefix") so each worker keeps to its own themes.
+    """
+    if by == "prefix":
+        groups = {}
+        for item_id in minifig_ids:
+            groups.setdefault(item_prefix(item_id), []).append(item_id)
+        result = [[] for _ in range(shards)]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(result, key=len).extend(group)
+        return result
+    size = -(-len(minifig_ids) // shards)
+    return [minifig_ids[i * size:(i + 1) * size] for i in range(shards)]
+
+
+def save_opportunities(arbitrage_data, table):
+    """
+    Upserts new opportunities into the opportunity store, replacing existing
+    rows with the same ItemID and Condition.
+    """
+    if arbitrage_data:
+        upsert(table, arbitrage_data)
+        print(f"Found {len(arbitrage_data)} arbitrage opportunities. Saved to {table}.")
+    else:
+        print("No new arbitrage opportunities found.")
+
+
+def drop_suppressed(minifig_ids, guide_types=()):
+    """
+    Leaves out minifigs the negative cache is holding back: ones that were
+    missing or out of stock, plus ones suppressed for any of guide_types
+    (e.g. 'subsets' for minifigs without parts).
+    """
+    suppressed = get_suppressed()
+    if not suppressed:
+        return minifig_ids
+    keys = [None] + list(guide_types)
+    return [item_id for item_id in minifig_ids
+            if not any(negative_key('MINIFIG', item_id, guide_type) in suppressed for guide_type in keys)]
+
+
+def update_negative_cache(status):
+    """
+    Backs off minifigs whose stock guides all came back empty and clears the
+    ones that have stock again (see batch_evaluator.stock_status).
+    """
+    for item_id, state in status.items():
+        if state == 'empty':
+            mark_negative(negative_key('MINIFIG', item_id), "no stock")
+        elif state == 'stocked':
+            clear_negative(negative_key('MINIFIG', item_id))
@@ -0,0 +1,377 @@
+import numpy as np
+import pandas as pd
+
+TIER_COLUMNS = ['item_type', 'item_id', 'color_id', 'condition', 'guide_type', 'country_code',
+                'seller_country_code', 'quantity', 'unit_price', 'shipping_available', 'total_quantity']
+KEYS = ['item_id', 'condition']
+
+
+def tiers_frame(requests, results):
+    """
+    Converts fetched price guides into one typed DataFrame with a row per tier,
+    in the same layout as the price snapshots and sorted by sort_tiers. Prices
+    and quantities are parsed from the JSON strings once, here. Guides without
+    tiers keep one row with empty tier columns so their totals are still available.
+
+    :param requests: {key: (item_type, item_id, condition, guide_type, country_code, color_id)}
+    :param results: {key: price guide 'data' block or None}, e.g. helper_functions.batch_results
+    """
+    columns = {column: [] for column in TIER_COLUMNS}
+    for key, (item_type, item_id, condition, guide_type, country_code, color_id) in requests.items():
+        data = results.get(key)
+        if data is None:
+            continue
+        total_quantity = _number(data.get('total_quantity'))
+        for tier in data.get('price_detail') or [{}]:
+            columns['item_type'].append(item_type)
+            columns['item_id'].append(item_id)
+            columns['color_id'].append(color_id)
+            columns['condition'].append(condition)
+            columns['guide_type'].append(guide_type)
+            columns['country_code'].append(country_code)
+            columns['seller_country_code'].append(tier.get('seller_country_code'))
+            columns['quantity'].append(_number(tier.get('quantity')))
+            columns['unit_price'].append(_number(tier.get('unit_price')))
+            columns['shipping_available'].append(bool(tier.get('shipping_available')))
+            columns['total_quantity'].append(total_quantity)
+    df = pd.DataFrame({
+        column: np.array(values, dtype='float64') if column in ('quantity', 'unit_price', 'total_quantity')
+        else np.array(values, dtype=bool) if column == 'shipping_available'
+        else pd.array(values, dtype='Int64') if column == 'color_id'
+        else np.array(values, dtype=object)
+        for column, values in columns.items()
+    })
+    return sort_tiers(df)
+
+
+def _number(value):
+    return np.nan if value is None else float(value)
+
+
+def sort_tiers(guides):
+    """
+    Sorts the tiers by unit price, once per batch. The stable sort keeps the
+    guide's own order between tiers with the same price, and tiers without a
+    price go last. Row filters keep this order, so the evaluators take the
+    first row per key as its cheapest tier and find the tiers at or above a
+    minimum price with a binary search; they expect guides sorted like this.
+    """
+    return guides.sort_values('unit_price', kind='stable', na_position='last').reset_index(drop=True)
+
+
+def compositions_frame(bom_by_item):
+    """
+    Converts {item_id: [BomLine, ...]} into the compositions DataFrame
+    evaluate_parts expects, one row per line in each minifig's BOM order.
+    """
+    rows = [(item_id, line.part_no, line.color_id, line.quantity)
+            for item_id, bom in bom_by_item.items() for line in bom]
+    df = pd.DataFrame(rows, columns=['item_id', 'part_no', 'color_id', 'quantity']).astype(object)
+    df['color_id'] = pd.to_numeric(df['color_id']).astype('Int64')
+    df['quantity'] = pd.to_numeric(df['quantity']).astype('int64')
+    return df
+
+
+def _listings(guides, item_type, country_code=None):
+    """
+    Tiers of the stock guides for item_type that ship to us, optionally only
+    from the guide requested with country_code.
+    """
+    stock = guides[(guides['item_type'] == item_type) & (guides['guide_type'] == 'stock') &
+                   (guides['shipping_available'] == True) & guides['unit_price'].notna()]
+    if country_code:
+        return stock[stock['country_code'] == country_code]
+    return stock[stock['country_code'].isna()]
+
+
+def _first_tiers(tiers, keys):
+    """
+    The cheapest tier per key: the first, as tiers keep sort_tiers' order.
+    """
+    return tiers.drop_duplicates(keys)
+
+
+def _priced_from(tiers, min_price):
+    """
+    The tiers priced at min_price or more, found by binary search on the
+    price-sorted tiers.
+    """
+    return tiers.iloc[np.searchsorted(tiers['unit_price'].to_numpy(), min_price, side='left'):]
+
+
+def _sell_thru(guides, item_type):
+    """
+    Six month sold quantity over current stock per (item_id, condition) for the
+    colorless guides of item_type. Missing where stock is zero or a guide is missing.
+    """
+    guides = guides[(guides['item_type'] == item_type) & guides['country_code'].isna() & guides['color_id'].isna()]
+    stock = guides[guides['guide_type'] == 'stock'].groupby(KEYS)['total_quantity'].first()
+    sold = guides[guides['guide_type'] == 'sold'].groupby(KEYS)['total_quantity'].first()
+    return (sold / stock.where(stock > 0)).dropna().rename('sell_thru')
+
+
+def _python_sum(values):
+    # A plain left-to-right running total; pandas' own sum is compensated and
+    # can land on the other side of a rounding boundary
+    return sum(values.tolist())
+
+
+def _round(series):
+    # Python's round() on each value, which pandas' vectorised round doesn't always match
+    return series.map(lambda value: round(value, 2))
+
+
+def country_minima(guides, item_type='MINIFIG'):
+    """
+    The cheapest listing that ships to us per item, condition and seller
+    country, all read from the unfiltered stock guides, as a DataFrame of
+    item_id, condition, seller_country_code, unit_price and quantity.
+    Sellers without a country code share one row.
+    """
+    stock = _listings(guides, item_type)
+    return _first_tiers(stock, KEYS + ['seller_country_code'])[KEYS + ['seller_country_code', 'unit_price', 'quantity']]
+
+
+def _us_prices(guides):
+    """
+    Cheapest US listing per minifig and condition. It is read from the US
+    sellers in the unfiltered stock guide, except where a US-only guide was
+    fetched because the unfiltered one was truncated (or, in older snapshots,
+    always), which then decides alone.
+    """
+    us_only = _first_tiers(_listings(guides, 'MINIFIG', 'US'), KEYS).set_index(KEYS)['unit_price']
+    fetched = guides[(guides['item_type'] == 'MINIFIG') & (guides['guide_type'] == 'stock') &
+                     (guides['country_code'] == 'US')].set_index(KEYS).index.unique()
+    minima = country_minima(guides)
+    unfiltered = minima[minima['seller_country_code'] == 'US'].set_index(KEYS)['unit_price']
+    unfiltered = unfiltered[~unfiltered.index.isin(fetched)]
+    return pd.concat([us_only, unfiltered]).rename('us_price')
+
+
+def _cheapest_intl(guides, thresholds):
+    """
+    The cheapest international tier per minifig and condition with at least
+    min_intl_quantity pieces at min_price or more, once per row of the
+    thresholds DataFrame, tagged with that row's two values.
+    """
+    stock = _listings(guides, 'MINIFIG')
+    intl = stock[stock['seller_country_code'] != 'US'][KEYS + ['unit_price', 'quantity']]
+    best = []
+    for min_quantity, min_price in thresholds.itertuples(index=False):
+        candidates = _priced_from(intl, min_price)
+        candidates = candidates[candidates['quantity'] >= min_quantity]
+        best.append(_first_tiers(candidates, KEYS).assign(min_intl_quantity=min_quantity, min_price=min_price))
+    return pd.concat(best, ignore_index=True)
+
+
+def lowest_prices(guides, min_intl_quantity=1, min_price=0):
+    """
+    The cheapest US listing and the cheapest international listing with at
+    least min_intl_quantity pieces at min_price or more, per minifig and
+    condition, as a DataFrame of item_id, condition, us_price, intl_price and
+    intl_quantity. Missing prices are NaN.
+    """
+    thresholds = pd.DataFrame({'min_intl_quantity': [min_intl_quantity], 'min_price': [min_price]})
+    intl = _cheapest_intl(guides, thresholds).set_index(KEYS)[['unit_price', 'quantity']]
+    intl = intl.rename(columns={'unit_price': 'intl_price', 'quantity': 'intl_quantity'})
+    return pd.concat([_us_prices(guides), intl], axis=1).rename_axis(KEYS).reset_index()
+
+
+def evaluate_minifigs(guides, param_sets):
+    """
+    Finds minifigs whose cheapest international listing with at least
+    min_intl_quantity pieces at min_price or more costs no more than
+    discount_rate times the cheapest US listing, and that sell at least
+    sell_thru_rate. Every minifig in guides (sorted by sort_tiers) is checked
+    under every parameter set (a dict of those four values) at once.
+    Returns one row per opportunity, tagged with the parameter set's index.
+    """
+    items = pd.concat([_us_prices(guides), _sell_thru(guides, 'MINIFIG')], axis=1).dropna()
+    params = pd.DataFrame(param_sets)
+    params['param_set'] = range(len(params))
+    best = _cheapest_intl(guides, params[['min_intl_quantity', 'min_price']].drop_duplicates())
+
+    merged = params.merge(best, on=['min_intl_quantity', 'min_price']).merge(items, left_on=KEYS, right_index=True)
+    hits = merged[(merged['unit_price'] <= merged['discount_rate'] * merged['us_price']) &
+                  (merged['sell_thru'] >= merged['sell_thru_rate'])]
+    result = pd.DataFrame({
+        'param_set': hits['param_set'],
+        'ItemID': hits['item_id'],
+        'Condition': hits['condition'],
+        'Intl Price': _round(hits['unit_price']),
+        'US Price': _round(hits['us_price']),
+        'Intl Quantity': hits['quantity'].astype(int),
+        'Sell Thru Rate': _round(hits['sell_thru'])
+    })
+    return result.sort_values(['param_set', 'ItemID', 'Condition']).reset_index(drop=True)
+
+
+def evaluate_parts(guides, compositions, param_sets):
+    """
+    Finds minifigs worth breaking (the cheapest minifig costs no more than
+    discount_rate times its fast-selling parts) or building (buying every part
+    costs no more than discount_rate times the cheapest minifig). Every minifig
+    in guides (sorted by sort_tiers) is checked under every parameter set at
+    once. Each parameter set is a dict of discount_rate, sell_thru_rate_minifig,
+    sell_thru_rate_part, min_minifig_quantity and min_minifig_price.
+
+    :param compositions: DataFrame of item_id, part_no, color_id, quantity with
+        one row per (part_no, color_id), as built by compositions_frame
+    """
+    columns = ['param_set', 'ItemID', 'Condition', 'Break or Build', 'Parts Considered', 'Minifig Price',
+               'Minifig Sell Thru Rate', 'Minifig Quantity', 'Parts Combined Price']
+
+    # Cheapest minifig listing and sell-thru rate per minifig and condition
+    first_minifig = _first_tiers(_listings(guides, 'MINIFIG'), KEYS)[KEYS + ['unit_price', 'quantity']]
+    first_minifig = first_minifig.rename(columns={'unit_price': 'minifig_price', 'quantity': 'minifig_quantity'})
+    items = first_minifig.merge(_sell_thru(guides, 'MINIFIG').rename('minifig_sell_thru').reset_index(), on=KEYS)
+    items = items[items['minifig_sell_thru'] > 0]
+
+    # Each BOM line is priced in its own colour and counted quantity times
+    parts = compositions.reset_index(drop=True)
+    parts['position'] = parts.index
+    parts['label'] = parts['part_no'].where(parts['quantity'] == 1,
+                                            parts['part_no'] + ' x' + parts['quantity'].astype(str))
+
+    # Parts without any listings are left out of both checks
+    part_tiers = _listings(guides, 'PART').rename(columns={'item_id': 'part_no'})
+    part_tiers = part_tiers[part_tiers['color_id'].notna()]
+    cheapest_parts = _first_tiers(part_tiers, ['part_no', 'color_id', 'condition'])
+    cheapest_parts = cheapest_parts[['part_no', 'color_id', 'condition', 'unit_price']]
+    part_rows = items[KEYS].merge(parts, on='item_id').merge(cheapest_parts, on=['part_no', 'color_id', 'condition'])
+    part_sell_thru = _sell_thru(guides, 'PART').rename('part_sell_thru').reset_index().rename(columns={'item_id': 'part_no'})
+    part_rows = part_rows.merge(part_sell_thru, on=['part_no', 'condition'], how='left')
+    part_rows = part_rows.sort_values(KEYS + ['position'])
+    # Every listing of each line's part, for the build check's quantity threshold,
+    # back in price order after the merge
+    line_tiers = part_rows[KEYS + ['position', 'part_no', 'color_id', 'quantity']].merge(
+        part_tiers[['part_no', 'color_id', 'condition', 'unit_price', 'quantity']].rename(
+            columns={'unit_price': 'tier_price', 'quantity': 'tier_quantity'}),
+        on=['part_no', 'color_id', 'condition'])
+    line_tiers = line_tiers.sort_values('tier_price', kind='stable')
+    build_labels = part_rows.groupby(KEYS)['label'].agg(', '.join).rename('parts').reset_index()
+
+    # Break totals only depend on sell_thru_rate_part and build totals on
+    # min_minifig_quantity, so each is worked out once per distinct value
+    break_totals_by_rate = {}
+    build_totals_by_quantity = {}
+    results = []
+    for param_set, params in enumerate(param_sets):
+        eligible = items[items['minifig_price'] >= params['min_minifig_price']]
+
+        # Break: buy the cheapest minifig and sell the parts that move fast enough
+        breakable = eligible[eligible['minifig_quantity'] >= params['min_minifig_quantity']]
+        rate = params['sell_thru_rate_part']
+        if rate not in break_totals_by_rate:
+            break_totals_by_rate[rate] = _break_totals(part_rows, rate)
+        breaks = breakable.merge(break_totals_by_rate[rate], on=KEYS, how='left')
+        breaks['parts_price'] = breaks['parts_price'].fillna(0.0)
+        breaks['parts'] = breaks['parts'].fillna('')
+        breaks = breaks[breaks['minifig_price'] <= params['discount_rate'] * breaks['parts_price']]
+        results.append(pd.DataFrame({
+            'param_set': param_set,
+            'ItemID': breaks['item_id'],
+            'Condition': breaks['condition'],
+            'Break or Build': 'Break',
+            'Parts Considered': breaks['parts'],
+            'Minifig Price': _round(breaks['minifig_price']),
+            'Minifig Sell Thru Rate': _round(breaks['minifig_sell_thru']),
+            'Minifig Quantity': breaks['minifig_quantity'].astype(int),
+            'Parts Combined Price': _round(breaks['parts_price'])
+        }, columns=columns))
+
+        # Build: buy each line from the cheapest seller with enough of the part
+        buildable = eligible[eligible['minifig_sell_thru'] >= params['sell_thru_rate_minifig']]
+        quantity = params['min_minifig_quantity']
+        if quantity not in build_totals_by_quantity:
+            build_totals_by_quantity[quantity] = _build_totals(part_rows, line_tiers, quantity).merge(build_labels, on=KEYS)
+        builds = buildable.merge(build_totals_by_quantity[quantity], on=KEYS)
+        builds = builds[~builds['failed'].astype(bool) & (builds['build_cost'] > 0) &
+                        (builds['build_cost'] <= params['discount_rate'] * builds['minifig_price'])]
+        results.append(pd.DataFrame({
+            'param_set': param_set,
+            'ItemID': builds['item_id'],
+            'Condition': builds['condition'],
+            'Break or Build': 'Build',
+            'Parts Considered': builds['parts'],
+            'Minifig Price': _round(builds['minifig_price']),
+            'Minifig Sell Thru Rate': _round(builds['minifig_sell_thru']),
+            'Minifig Quantity': params['min_minifig_quantity'],
+            'Parts Combined Price': _round(builds['build_cost'])
+        }, columns=columns))
+
+    result = pd.concat(results, ignore_index=True)
+    return result.sort_values(['param_set', 'ItemID', 'Condition', 'Break or Build']).reset_index(drop=True)
+
+
+def _break_totals(part_rows, sell_thru_rate_part):
+    """
+    Combined price and labels per minifig and condition of the lines whose
+    part sells at least sell_thru_rate_part.
+    """
+    selling = part_rows[(part_rows['part_sell_thru'] > 0) & (part_rows['part_sell_thru'] >= sell_thru_rate_part)]
+    selling = selling.assign(line_price=selling['unit_price'] * selling['quantity'])
+    return selling.groupby(KEYS).agg(parts_price=('line_price', _python_sum),
+                                     parts=('label', ', '.join)).reset_index()
+
+
+def _build_totals(part_rows, line_tiers, min_minifig_quantity):
+    """
+    Cost per minifig and condition of buying min_minifig_quantity copies of
+    every line, each line from the cheapest tier with enough of its part, and
+    whether some line has no such tier.
+    """
+    offers = line_tiers[line_tiers['tier_quantity'] >= min_minifig_quantity * line_tiers['quantity']]
+    # line_tiers is in price order, so the first offer per line is the cheapest
+    build_prices = offers.drop_duplicates(KEYS + ['position'])[KEYS + ['position', 'tier_price']]
+    build_rows = part_rows.merge(build_prices.rename(columns={'tier_price': 'build_price'}),
+                                 on=KEYS + ['position'], how='left')
+    build_rows['line_cost'] = build_rows['build_price'] * build_rows['quantity']
+    build_rows['missing'] = build_rows['build_price'].isna()
+    return build_rows.groupby(KEYS).agg(build_cost=('line_cost', _python_sum),
+                                        failed=('missing', 'any')).reset_index()
+
+
+def item_metrics(guides, item_ids):
+    """
+    What a scan saw for each minifig, for the scan scheduler: the cheapest
+    listing, the best sell-thru rate and the widest relative gap between the
+    cheapest US and international listings (from country_minima), across
+    both conditions.
+    Missing values are None.
+    """
+    minima = country_minima(guides)
+    is_us = minima['seller_country_code'] == 'US'
+    us_price = minima[is_us].set_index(KEYS)['unit_price']
+    intl_price = minima[~is_us].groupby(KEYS)['unit_price'].min()
+    spread = ((us_price - intl_price) / us_price).groupby(level='item_id').max()
+    price = minima.groupby('item_id')['unit_price'].min()
+    sell_thru = _sell_thru(guides, 'MINIFIG').groupby(level='item_id').max()
+    frame = pd.DataFrame({'price': price, 'sell_thru': sell_thru, 'spread': spread}).reindex(list(item_ids))
+    frame = frame.astype(object).where(frame.notna(), None)
+    return frame.to_dict('index')
+
+
+def stock_status(guides, item_ids, conditions=('N', 'U')):
+    """
+    Sorts scanned minifigs by their unfiltered stock guides: 'stocked' if any
+    condition has stock, 'empty' if every condition's guide came back with
+    none, and None if that can't be told (e.g. a request failed).
+    """
+    stock = guides[(guides['item_type'] == 'MINIFIG') & (guides['guide_type'] == 'stock') &
+                   guides['country_code'].isna()]
+    per_condition = stock.groupby(KEYS).agg(total=('total_quantity', 'max'), tiers=('unit_price', 'count'))
+    has_stock = ((per_condition['total'].fillna(0) > 0) | (per_condition['tiers'] > 0)).groupby(level='item_id')
+    stocked = has_stock.any()
+    guides_seen = has_stock.size()
+    status = {}
+    for item_id in item_ids:
+        if item_id not in stocked.index:
+            status[item_id] = None
+        elif stocked[item_id]:
+            status[item_id] = 'stocked'
+        elif guides_seen[item_id] == len(conditions):
+            status[item_id] = 'empty'
+        else:
+            status[item_id] = None
+    return status
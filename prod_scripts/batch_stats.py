@@ -0,0 +1,119 @@
+import json
+import os
+import time
+import statistics
+from sqlite_store import connect
+
+STATS_FILE = "flags/batch_stats.db"
+# Where samples were kept before, imported the first time the database is used
+LEGACY_STATS_FILE = "flags/batch_stats.json"
+# Number of recent batches kept per category
+MAX_SAMPLES = 50
+# Aim for batches that finish in about this long, so checkpoints stay frequent
+TARGET_BATCH_SECONDS = 60
+
+_conn = None
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(STATS_FILE, explicit_transactions=True)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS samples (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT NOT NULL,
+                calls_per_item REAL NOT NULL,
+                seconds_per_item REAL NOT NULL,
+                recorded_at REAL NOT NULL
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_samples_category ON samples (category, id)")
+        _import_legacy_stats(_conn)
+    return _conn
+
+
+def _import_legacy_stats(conn):
+    """
+    Carries the samples over from the old batch_stats.json into an empty database.
+    """
+    if not os.path.exists(LEGACY_STATS_FILE):
+        return
+    try:
+        with open(LEGACY_STATS_FILE, "r") as f:
+            stats = json.load(f)
+    except (ValueError, OSError):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM samples LIMIT 1").fetchone() is None:
+            conn.executemany(
+                "INSERT INTO samples (category, calls_per_item, seconds_per_item, recorded_at) VALUES (?, ?, ?, 0)",
+                [(category, s['calls_per_item'], s['seconds_per_item'])
+                 for category, samples in stats.items() for s in samples]
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def record_batch(category, items, calls, seconds):
+    """
+    Records how many API calls and seconds a batch of `items` minifigs took,
+    keeping the last MAX_SAMPLES batches per category. Safe to call from
+    several scanner processes at once.
+    """
+    if items <= 0:
+        return
+    conn = _get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT INTO samples (category, calls_per_item, seconds_per_item, recorded_at) VALUES (?, ?, ?, ?)",
+                     (category, calls / items, seconds / items, time.time()))
+        conn.execute(
+            "DELETE FROM samples WHERE category = ? AND id NOT IN "
+            "(SELECT id FROM samples WHERE category = ? ORDER BY id DESC LIMIT ?)",
+            (category, category, MAX_SAMPLES)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def get_category_stats(category):
+    """
+    Returns mean/p90 calls and mean seconds per item for a category, or None
+    if no batches have been recorded for it yet.
+    """
+    samples = _get_conn().execute(
+        "SELECT calls_per_item, seconds_per_item FROM samples WHERE category = ?", (category,)
+    ).fetchall()
+    if not samples:
+        return None
+    calls = sorted(s[0] for s in samples)
+    return {
+        'batches': len(samples),
+        'mean_calls_per_item': statistics.mean(calls),
+        'p90_calls_per_item': calls[min(len(calls) - 1, int(len(calls) * 0.9))],
+        'mean_seconds_per_item': statistics.mean(s[1] for s in samples)
+    }
+
+
+def next_batch_size(category, remaining_calls, default, min_size=1, max_size=200, target_seconds=TARGET_BATCH_SECONDS):
+    """
+    Sizes the next batch so it fits both the remaining API budget (using the
+    p90 calls per item seen for this category) and the target wall-clock time.
+    Falls back to default until the category has some history.
+    """
+    stats = get_category_stats(category)
+    if stats is None:
+        size = default
+    else:
+        size = max_size
+        if stats['p90_calls_per_item'] > 0:
+            size = min(size, int(remaining_calls / stats['p90_calls_per_item']))
+        if stats['mean_seconds_per_item'] > 0:
+            size = min(size, int(target_seconds / stats['mean_seconds_per_item']))
+    return max(min_size, min(size, max_size))
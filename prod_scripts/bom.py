@@ -0,0 +1,24 @@
+from typing import NamedTuple
+
+
+class BomLine(NamedTuple):
+    """
+    One line of a minifig's bill of materials: a part in one colour and how
+    many of it the minifig contains.
+    """
+    part_no: str
+    color_id: int
+    quantity: int
+
+
+def build_bom(entries):
+    """
+    Turns (part_no, color_id, quantity) subset entries into BomLines, one per
+    (part_no, color_id). Quantities of repeated entries are added up, and
+    each line keeps the position its part and colour first appeared in.
+    """
+    quantities = {}
+    for part_no, color_id, quantity in entries:
+        quantities[(part_no, color_id)] = quantities.get((part_no, color_id), 0) + quantity
+    return [BomLine(part_no, color_id, quantity) for (part_no, color_id), quantity in quantities.items()]
+
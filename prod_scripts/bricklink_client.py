@@ -0,0 +1,125 @@
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+from dotenv import load_dotenv
+from fetch_engine import MAX_IN_FLIGHT, rate_limiter
+from call_metrics import record_request, timed
+from budget_ledger import record_call, reserve, release, calls_today, remaining_today
+load_dotenv()
+
+BASE_URL = os.getenv("BRICKLINK_BASE_URL", 'https://api.bricklink.com/api/store/v1')
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+# Longest wait before a retry, whatever Retry-After asks for
+MAX_BACKOFF = 120
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class BrickLinkClient:
+    """
+    Keep-alive session for the BrickLink store API. Requests are OAuth1 signed,
+    share one connection pool and are retried with exponential backoff on
+    429 and 5xx responses and connection errors. Calls, retries included,
+    are counted in the budget ledger and paced by the shared rate limiter
+    (see checkout).
+    """
+
+    def __init__(self, consumer_key=None, consumer_secret=None, token_value=None, token_secret=None,
+                 base_url=BASE_URL, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, pool_size=MAX_IN_FLIGHT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+        self.backoff_factor = backoff_factor
+        self.session = requests.Session()
+        self.session.auth = OAuth1(
+            consumer_key or os.getenv("BRICKLINK_CONSUMER_KEY"),
+            consumer_secret or os.getenv("BRICKLINK_CONSUMER_SECRET"),
+            token_value or os.getenv("BRICKLINK_TOKEN_VALUE"),
+            token_secret or os.getenv("BRICKLINK_TOKEN_SECRET")
+        )
+        # no retries in the adapter: get() retries itself so each attempt goes through checkout()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, params=None):
+        """
+        GETs BASE_URL + path, e.g. client.get("/items/MINIFIG/sw0001/price", params).
+        The caller checks out the first attempt (see helper_functions.throttle);
+        each retry is checked out here, so it is budgeted and rate limited
+        like any other call. Raises ApiLimitReached if a retry would go over
+        the budget, and the last connection error if every attempt failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                with timed('retry_backoff'):
+                    time.sleep(self._backoff(attempt, response))
+                self.checkout()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                response = None
+                continue
+            record_request(path, response, time.perf_counter() - started, attempt)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        return response
+
+    def _backoff(self, attempt, response):
+        """
+        Seconds to wait before retry number `attempt`: the response's
+        Retry-After if it sent one, else exponential backoff.
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), MAX_BACKOFF)
+        return min(self.backoff_factor * 2 ** (attempt - 1), MAX_BACKOFF)
+
+    def checkout(self):
+        """
+        Records one call in today's budget, raising ApiLimitReached if it is
+        spent, then waits for the rate limiter. Returns the client.
+        """
+        with timed('budget'):
+            record_call()
+        with timed('rate_limit'):
+            self.rate_limiter.acquire()
+        return self
+
+    def remaining_today(self):
+        return remaining_today()
+
+    def calls_today(self):
+        return calls_today()
+
+    def reserve(self, calls):
+        return reserve(calls)
+
+    def release(self):
+        release()
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+
+
+def get_default_client():
+    """
+    Returns the process-wide client built from the BRICKLINK_* environment variables.
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = BrickLinkClient()
+    return _default_client
@@ -0,0 +1,179 @@
+import os
+import threading
+from datetime import datetime
+from sqlite_store import connect
+
+LEDGER_FILE = "flags/api_budget.db"
+LEGACY_COUNT_FILE = "flags/api_call_count.txt"
+DAILY_LIMIT = 5000
+DEFAULT_ACCOUNT = "default"
+
+_conn = None
+_lock = threading.RLock()
+# Calls this process has reserved but not used yet, per (day, account)
+_reserved = {}
+
+
+class ApiLimitReached(RuntimeError):
+    """Raised when a call would take an account past its daily API limit."""
+
+
+def _today():
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def _holder():
+    return str(os.getpid())
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(LEDGER_FILE, explicit_transactions=True, threaded=True)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                account TEXT NOT NULL,
+                used INTEGER NOT NULL,
+                PRIMARY KEY (day, account)
+            )
+        """)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS reservations (
+                day TEXT NOT NULL,
+                account TEXT NOT NULL,
+                holder TEXT NOT NULL,
+                reserved INTEGER NOT NULL,
+                PRIMARY KEY (day, account, holder)
+            )
+        """)
+        _import_legacy_count(_conn)
+    return _conn
+
+
+def _import_legacy_count(conn):
+    """
+    Carries today's count over from the old api_call_count.txt file the
+    first time the ledger is used, so switching mid-day doesn't overrun.
+    """
+    if not os.path.exists(LEGACY_COUNT_FILE):
+        return
+    try:
+        with open(LEGACY_COUNT_FILE, "r") as f:
+            lines = f.readlines()
+        file_date = lines[0].strip() if len(lines) > 0 else ""
+        file_count = int(lines[1].strip()) if len(lines) > 1 and lines[1].strip().isdigit() else 0
+    except Exception:
+        return
+    if file_date == _today():
+        conn.execute("INSERT OR IGNORE INTO usage (day, account, used) VALUES (?, ?, ?)",
+                     (file_date, DEFAULT_ACCOUNT, file_count))
+
+
+def _clear_stale_reservations(conn, day):
+    """
+    Drops reservations left behind by processes that have exited.
+    """
+    for (holder,) in conn.execute("SELECT DISTINCT holder FROM reservations WHERE day = ?", (day,)).fetchall():
+        try:
+            os.kill(int(holder), 0)
+        except ProcessLookupError:
+            conn.execute("DELETE FROM reservations WHERE holder = ?", (holder,))
+        except (PermissionError, ValueError):
+            pass
+    conn.execute("DELETE FROM reservations WHERE day != ?", (day,))
+
+
+def _used(conn, day, account):
+    row = conn.execute("SELECT used FROM usage WHERE day = ? AND account = ?", (day, account)).fetchone()
+    return row[0] if row else 0
+
+
+def _reserved_by_others(conn, day, account):
+    row = conn.execute(
+        "SELECT COALESCE(SUM(reserved), 0) FROM reservations WHERE day = ? AND account = ? AND holder != ?",
+        (day, account, _holder())
+    ).fetchone()
+    return row[0]
+
+
+def record_call(account=DEFAULT_ACCOUNT, limit=DAILY_LIMIT):
+    """
+    Records one API call against today's budget. Calls are taken from this
+    process's reservation first, then from unreserved headroom.
+    Raises ApiLimitReached if neither has room left.
+    """
+    day = _today()
+    with _lock:
+        conn = _get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _reserved.get((day, account), 0) > 0:
+                _reserved[(day, account)] -= 1
+                conn.execute(
+                    "UPDATE reservations SET reserved = reserved - 1 WHERE day = ? AND account = ? AND holder = ?",
+                    (day, account, _holder())
+                )
+            elif _used(conn, day, account) + _reserved_by_others(conn, day, account) >= limit:
+                raise ApiLimitReached(f"API limit of {limit} calls reached for {account} today")
+            conn.execute(
+                "INSERT INTO usage (day, account, used) VALUES (?, ?, 1) "
+                "ON CONFLICT (day, account) DO UPDATE SET used = used + 1",
+                (day, account)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def reserve(calls, account=DEFAULT_ACCOUNT, limit=DAILY_LIMIT):
+    """
+    Sets aside up to `calls` calls of today's budget for this process so other
+    processes can't spend them. Returns how many were actually reserved.
+    """
+    day = _today()
+    with _lock:
+        conn = _get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _clear_stale_reservations(conn, day)
+            mine = _reserved.get((day, account), 0)
+            headroom = limit - _used(conn, day, account) - _reserved_by_others(conn, day, account) - mine
+            granted = max(0, min(calls, headroom))
+            _reserved[(day, account)] = mine + granted
+            conn.execute(
+                "INSERT OR REPLACE INTO reservations (day, account, holder, reserved) VALUES (?, ?, ?, ?)",
+                (day, account, _holder(), _reserved[(day, account)])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return granted
+
+
+def release(account=DEFAULT_ACCOUNT):
+    """
+    Hands any unused reservation back to the shared budget.
+    """
+    with _lock:
+        _reserved[(_today(), account)] = 0
+        _get_conn().execute("DELETE FROM reservations WHERE account = ? AND holder = ?", (account, _holder()))
+
+
+def calls_today(account=DEFAULT_ACCOUNT):
+    with _lock:
+        return _used(_get_conn(), _today(), account)
+
+
+def remaining_today(account=DEFAULT_ACCOUNT, limit=DAILY_LIMIT):
+    """
+    Returns how many calls this process can still make today: its own
+    reservation plus headroom not used or reserved by anyone else.
+    """
+    day = _today()
+    with _lock:
+        conn = _get_conn()
+        mine = _reserved.get((day, account), 0)
+        return max(0, limit - _used(conn, day, account) - _reserved_by_others(conn, day, account) - mine) + mine
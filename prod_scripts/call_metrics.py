@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from sampling_profiler import SamplingProfiler
+
+METRICS_DIR = "flags/metrics"
+CALLS_FILE = os.path.join(METRICS_DIR, "calls.jsonl")
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Written after every batch: "jsonl" appends each call and a batch summary to
+# CALLS_FILE, "prom" rewrites a Prometheus textfile per process in METRICS_DIR
+outputs = set()
+# When True every batch runs under the sampling profiler
+profile = False
+
+_lock = threading.Lock()
+_batch = None
+# Everything since the process started, for the Prometheus counters
+_totals = None
+_profiler = None
+
+
+def configure(argv):
+    """
+    Turns on the outputs named by --metrics=jsonl,prom and the profiler for
+    --profile in argv.
+    """
+    global profile
+    for arg in argv:
+        if arg.startswith("--metrics="):
+            outputs.update(name for name in arg.split("=", 1)[1].split(",") if name)
+        elif arg == "--profile":
+            profile = True
+
+
+def _new_aggregates(workflow):
+    return {
+        'workflow': workflow,
+        'started': time.time(),
+        'events': [],
+        # (endpoint, item_type, status) -> [calls, bytes, seconds, retries, bucket counts]
+        'requests': {},
+        # (endpoint, item_type, result) -> lookups answered without a call
+        'lookups': {},
+        # section -> seconds, summed over the fetch engine's worker threads
+        'sections': {},
+    }
+
+
+def _current():
+    global _batch, _totals
+    if _batch is None:
+        _batch = _new_aggregates("adhoc")
+    if _totals is None:
+        _totals = _new_aggregates(_batch['workflow'])
+    return _batch
+
+
+def _split_path(path):
+    # /items/MINIFIG/sw0001/price -> ("price", "MINIFIG")
+    parts = path.strip("/").split("/")
+    if len(parts) >= 4 and parts[0] == "items":
+        return parts[3], parts[1]
+    return path, ""
+
+
+def record_request(path, response, seconds, attempt=0):
+    """
+    Records one HTTP request made by BrickLinkClient.get: its endpoint, item
+    type, status, response size and latency. attempt is 0 for the first
+    request of a call and counts up for its retries.
+    """
+    endpoint, item_type = _split_path(path)
+    size = len(response.content)
+    retries = 1 if attempt else 0
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+    with _lock:
+        batch = _current()
+        for aggregates in (batch, _totals):
+            row = aggregates['requests'].setdefault((endpoint, item_type, response.status_code),
+                                                    [0, 0, 0.0, 0, [0] * (len(LATENCY_BUCKETS) + 1)])
+            row[0] += 1
+            row[1] += size
+            row[2] += seconds
+            row[3] += retries
+            row[4][bucket] += 1
+            aggregates['sections']['network'] = aggregates['sections'].get('network', 0.0) + seconds
+        if "jsonl" in outputs:
+            batch['events'].append({'endpoint': endpoint, 'item_type': item_type, 'status': response.status_code,
+                                    'bytes': size, 'seconds': round(seconds, 4), 'attempt': attempt, 'cache': 'miss'})
+
+
+def record_lookup(endpoint, item_type, result):
+    """
+    Records a lookup answered without a call: result is "hit" for the price
+    cache or composition store, "negative" for a known dead item.
+    """
+    with _lock:
+        batch = _current()
+        for aggregates in (batch, _totals):
+            key = (endpoint, item_type, result)
+            aggregates['lookups'][key] = aggregates['lookups'].get(key, 0) + 1
+        if "jsonl" in outputs:
+            batch['events'].append({'endpoint': endpoint, 'item_type': item_type, 'cache': result})
+
+
+@contextmanager
+def timed(section):
+    """
+    Adds the time spent in the block to the batch's section, e.g.
+    with timed('json'): data = response.json()
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            batch = _current()
+            for aggregates in (batch, _totals):
+                aggregates['sections'][section] = aggregates['sections'].get(section, 0.0) + elapsed
+
+
+def start_batch(workflow):
+    """
+    Starts aggregating a new batch of the workflow (the opportunities table),
+    under the sampling profiler if profiling is on.
+    """
+    global _batch, _profiler
+    with _lock:
+        _batch = _new_aggregates(workflow)
+        _current()
+    if profile:
+        if _profiler is None:
+            _profiler = SamplingProfiler()
+        _profiler.start()
+
+
+def finish_batch():
+    """
+    Prints where the batch's time went, writes the configured outputs and
+    returns the batch summary.
+    """
+    global _batch
+    with _lock:
+        batch = _current()
+        _batch = None
+    summary = _summary(batch)
+    sections = sorted(summary['sections'].items(), key=lambda item: -item[1])
+    if sections:
+        print("Time by section (summed over worker threads): " +
+              ", ".join(f"{section} {seconds:.1f}s" for section, seconds in sections))
+
+    if outputs:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+    if "jsonl" in outputs:
+        with open(CALLS_FILE, "a") as f:
+            for event in batch['events']:
+                f.write(json.dumps(dict(event, workflow=batch['workflow'], pid=os.getpid())) + "\n")
+            f.write(json.dumps(dict(summary, type="batch")) + "\n")
+    if "prom" in outputs:
+        _write_prometheus(batch['workflow'])
+    if _profiler is not None and profile:
+        _profiler.stop()
+        path = os.path.join(METRICS_DIR, f"profile_{batch['workflow']}_{os.getpid()}.folded")
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _profiler.write_folded(path)
+        print(f"Profile ({_profiler.samples} samples so far, stacks in {path}):")
+        for function, share in _profiler.top(10):
+            print(f"  {share * 100:5.1f}%  {function}")
+    return summary
+
+
+def _summary(batch):
+    calls = sum(row[0] for row in batch['requests'].values())
+    return {
+        'workflow': batch['workflow'],
+        'pid': os.getpid(),
+        'finished': datetime.utcnow().isoformat(),
+        'seconds': round(time.time() - batch['started'], 3),
+        'calls': calls,
+        'bytes': sum(row[1] for row in batch['requests'].values()),
+        'retries': sum(row[3] for row in batch['requests'].values()),
+        'statuses': _count_by(batch['requests'], 2, lambda row: row[0]),
+        'cache': dict(_count_by(batch['lookups'], 2, lambda count: count), miss=calls),
+        'latency_buckets': {str(bound): count for bound, count in
+                            zip(LATENCY_BUCKETS + ("+Inf",), _merged_buckets(batch['requests'].values()))},
+        'sections': {section: round(seconds, 3) for section, seconds in batch['sections'].items()},
+    }
+
+
+def _count_by(table, position, value):
+    counts = {}
+    for key, row in table.items():
+        counts[str(key[position])] = counts.get(str(key[position]), 0) + value(row)
+    return counts
+
+
+def _merged_buckets(rows):
+    merged = [0] * (len(LATENCY_BUCKETS) + 1)
+    for row in rows:
+        for i, count in enumerate(row[4]):
+            merged[i] += count
+    return merged
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def _write_prometheus(workflow):
+    """
+    Rewrites this process's textfile (for node_exporter's textfile collector)
+    with the counters since the process started.
+    """
+    with _lock:
+        requests = {key: [row[0], row[1], row[2], row[3], list(row[4])] for key, row in _totals['requests'].items()}
+        lookups = dict(_totals['lookups'])
+        sections = dict(_totals['sections'])
+    lines = [
+        "# HELP bricklink_api_requests_total API requests by endpoint, item type and status.",
+        "# TYPE bricklink_api_requests_total counter",
+    ]
+    for (endpoint, item_type, status), row in sorted(requests.items()):
+        lines.append(f"bricklink_api_requests_total{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type, status=status)} {row[0]}")
+    lines += ["# HELP bricklink_api_response_bytes_total Response body bytes by endpoint and item type.",
+              "# TYPE bricklink_api_response_bytes_total counter"]
+    lines += [f"bricklink_api_response_bytes_total{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type, status=status)} {row[1]}"
+              for (endpoint, item_type, status), row in sorted(requests.items())]
+    lines += ["# HELP bricklink_api_retries_total Requests that retried a 429, 5xx or connection error.",
+              "# TYPE bricklink_api_retries_total counter"]
+    lines += [f"bricklink_api_retries_total{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type, status=status)} {row[3]}"
+              for (endpoint, item_type, status), row in sorted(requests.items())]
+
+    lines += ["# HELP bricklink_api_request_seconds API request latency, one observation per attempt.",
+              "# TYPE bricklink_api_request_seconds histogram"]
+    by_endpoint = {}
+    for (endpoint, item_type, _), row in requests.items():
+        merged = by_endpoint.setdefault((endpoint, item_type), [0.0, [0] * (len(LATENCY_BUCKETS) + 1)])
+        merged[0] += row[2]
+        merged[1] = [a + b for a, b in zip(merged[1], row[4])]
+    for (endpoint, item_type), (seconds, buckets) in sorted(by_endpoint.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += count
+            lines.append(f"bricklink_api_request_seconds_bucket{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type, le=bound)} {cumulative}")
+        lines.append(f"bricklink_api_request_seconds_sum{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type)} {seconds:.4f}")
+        lines.append(f"bricklink_api_request_seconds_count{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type)} {cumulative}")
+
+    lines += ["# HELP bricklink_lookups_total Lookups answered without an API call.",
+              "# TYPE bricklink_lookups_total counter"]
+    lines += [f"bricklink_lookups_total{_labels(workflow=workflow, endpoint=endpoint, item_type=item_type, result=result)} {count}"
+              for (endpoint, item_type, result), count in sorted(lookups.items())]
+    lines += ["# HELP bricklink_section_seconds_total Time spent per section, summed over worker threads.",
+              "# TYPE bricklink_section_seconds_total counter"]
+    lines += [f"bricklink_section_seconds_total{_labels(workflow=workflow, section=section)} {seconds:.4f}"
+              for section, seconds in sorted(sections.items())]
+
+    path = os.path.join(METRICS_DIR, f"{workflow}_{os.getpid()}.prom")
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, path)
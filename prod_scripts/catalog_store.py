@@ -0,0 +1,244 @@
+import csv
+import os
+import re
+import time
+import threading
+from sqlite_store import connect
+
+STORE_FILE = "processed_data/catalog.db"
+# CSVs the catalog is seeded from until extract_catalog.py first fills the store
+LEGACY_CSV = "processed_data/all_minifigs.csv"
+LEGACY_FILTERED_CSV = "processed_data/all_minifigs_filtered.csv"
+
+# Minifig compositions almost never change, so they are only refetched after this long
+COMPOSITION_TTL = 180 * 24 * 60 * 60
+
+_conn = None
+# Compositions are looked up from the fetch engine's worker threads
+_lock = threading.RLock()
+
+
+def item_prefix(item_id):
+    """
+    The letters an item number starts with, lowercased: "sw0001a" -> "sw",
+    "shell001" -> "shell".
+    """
+    match = re.match(r"[a-z]+", (item_id or "").lower())
+    return match.group(0) if match else ""
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(STORE_FILE, threaded=True)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT PRIMARY KEY,
+                item_name TEXT,
+                category TEXT,
+                prefix TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_items_category ON items (category, position)")
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_items_prefix ON items (prefix, position)")
+        # minifig -> parts, with a reverse index from part (and color) to the minifigs using it
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS compositions (
+                item_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                part_no TEXT NOT NULL,
+                color_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                PRIMARY KEY (item_id, position)
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_compositions_part ON compositions (part_no, color_id)")
+        # when each minifig's composition was fetched, including minifigs with no parts
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS composition_fetches (
+                item_id TEXT PRIMARY KEY,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        # 'csv_imported': mtime of the LEGACY_CSV last imported; 'extracted': when
+        # extract_catalog.py last replaced the items, after which the CSVs are ignored
+        _conn.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+        _conn.commit()
+        _import_csv(_conn)
+    return _conn
+
+
+def _import_csv(conn):
+    """
+    Seeds the store from the all_minifigs CSVs until extract_catalog.py has
+    filled it, re-importing whenever the CSV has changed since the last
+    import, so a store opened before the CSV existed still picks it up.
+    Items missing from all_minifigs_filtered.csv (if present) are marked
+    deleted, but only those the filtered CSV can have seen: if it is older
+    than all_minifigs.csv, items new to the store are left alone.
+    """
+    if not os.path.exists(LEGACY_CSV):
+        return
+    info = dict(conn.execute("SELECT key, value FROM store_info"))
+    csv_mtime = os.path.getmtime(LEGACY_CSV)
+    if 'extracted' in info or info.get('csv_imported') == csv_mtime:
+        return
+    with open(LEGACY_CSV, newline='') as csvfile:
+        rows = [(row['item_id'], row.get('item_name'), row.get('category')) for row in csv.DictReader(csvfile)]
+    known = {row[0] for row in conn.execute("SELECT item_id FROM items")}
+    _replace(conn, rows)
+    if os.path.exists(LEGACY_FILTERED_CSV):
+        with open(LEGACY_FILTERED_CSV, newline='') as csvfile:
+            kept = {row['item_id'] for row in csv.DictReader(csvfile)}
+        current = os.path.getmtime(LEGACY_FILTERED_CSV) >= csv_mtime
+        with conn:
+            conn.executemany("UPDATE items SET deleted = 1 WHERE item_id = ?",
+                             [(item_id,) for item_id, _, _ in rows
+                              if item_id not in kept and (current or item_id in known)])
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO store_info (key, value) VALUES ('csv_imported', ?)", (csv_mtime,))
+    print(f"Imported {len(rows)} minifigs from {LEGACY_CSV}")
+
+
+def _replace(conn, rows):
+    with conn:
+        deleted = {row[0] for row in conn.execute("SELECT item_id FROM items WHERE deleted = 1")}
+        conn.execute("DELETE FROM items")
+        count = 0
+        for position, (item_id, item_name, category) in enumerate(rows):
+            conn.execute(
+                "INSERT OR REPLACE INTO items (item_id, item_name, category, prefix, position, deleted) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (item_id, item_name, category, item_prefix(item_id), position, int(item_id in deleted))
+            )
+            count += 1
+    return count
+
+
+def replace_items(rows):
+    """
+    Replaces the catalog with rows of (item_id, item_name, category) in one
+    transaction, keeping the deleted flag of items that are still listed.
+    rows may be a generator; it is consumed once. Returns the number of rows.
+    From then on the store is the catalog's source and the CSVs aren't imported.
+    """
+    with _lock:
+        conn = _get_conn()
+        count = _replace(conn, rows)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO store_info (key, value) VALUES ('extracted', ?)", (time.time(),))
+        return count
+
+
+def set_deleted(verdicts):
+    """
+    Records {item_id: deleted} verdicts from the deletion filter.
+    """
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.executemany("UPDATE items SET deleted = ? WHERE item_id = ?",
+                             [(int(deleted), item_id) for item_id, deleted in verdicts.items()])
+
+
+def _id_range(prefix):
+    """
+    (low, high) bounds of the item_ids starting with prefix, so a prefix
+    match can use the primary key index: "col" -> ("col", "com").
+    """
+    prefix = prefix.lower()
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def select_ids(prefix=None, category=None, include_deleted=False, exclude_prefixes=()):
+    """
+    Returns the item_ids starting with prefix, leaving out those starting
+    with any of exclude_prefixes, and/or in the category id, in catalog order.
+    """
+    clauses, params = [], []
+    if prefix:
+        clauses.append("item_id >= ? AND item_id < ?")
+        params.extend(_id_range(prefix))
+    for excluded in exclude_prefixes:
+        clauses.append("NOT (item_id >= ? AND item_id < ?)")
+        params.extend(_id_range(excluded))
+    if category:
+        clauses.append("category = ?")
+        params.append(str(category))
+    if not include_deleted:
+        clauses.append("deleted = 0")
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    with _lock:
+        return [row[0] for row in _get_conn().execute(f"SELECT item_id FROM items {where} ORDER BY position", params)]
+
+
+def count():
+    with _lock:
+        return _get_conn().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+
+def get_composition(item_id, ignore_ttl=False):
+    """
+    Returns the stored [(part_no, color_id, quantity), ...] of a minifig in
+    subset order, or None if it has never been fetched or is older than
+    COMPOSITION_TTL (unless ignore_ttl is set).
+    """
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute("SELECT fetched_at FROM composition_fetches WHERE item_id = ?", (item_id,)).fetchone()
+        if row is None or (not ignore_ttl and time.time() - row[0] > COMPOSITION_TTL):
+            return None
+        return conn.execute(
+            "SELECT part_no, color_id, quantity FROM compositions WHERE item_id = ? ORDER BY position", (item_id,)
+        ).fetchall()
+
+
+def put_composition(item_id, parts):
+    """
+    Stores a minifig's [(part_no, color_id, quantity), ...], replacing any
+    earlier composition.
+    """
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.execute("DELETE FROM compositions WHERE item_id = ?", (item_id,))
+            conn.executemany(
+                "INSERT INTO compositions (item_id, position, part_no, color_id, quantity) VALUES (?, ?, ?, ?, ?)",
+                [(item_id, position, part_no, color_id, quantity)
+                 for position, (part_no, color_id, quantity) in enumerate(parts)]
+            )
+            conn.execute("INSERT OR REPLACE INTO composition_fetches (item_id, fetched_at) VALUES (?, ?)",
+                         (item_id, time.time()))
+
+
+def minifigs_using(part_no, color_id=None):
+    """
+    Returns the minifigs whose stored composition includes part_no (in
+    color_id, if given), using the reverse index.
+    """
+    with _lock:
+        conn = _get_conn()
+        if color_id is None:
+            rows = conn.execute("SELECT DISTINCT item_id FROM compositions WHERE part_no = ?", (part_no,))
+        else:
+            rows = conn.execute("SELECT DISTINCT item_id FROM compositions WHERE part_no = ? AND color_id = ?",
+                                (part_no, color_id))
+        return [row[0] for row in rows]
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # Which minifigs use a part: catalog_store.py 3626c [color_id]
+        color_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print("\n".join(minifigs_using(sys.argv[1], color_id)) or "No stored minifig uses that part.")
+        sys.exit(0)
+    # Show what the catalog holds per prefix
+    for prefix, total, deleted in _get_conn().execute(
+        "SELECT prefix, COUNT(*), SUM(deleted) FROM items GROUP BY prefix ORDER BY COUNT(*) DESC LIMIT 20"
+    ):
+        print(f"{prefix or '(none)'}: {total} minifigs ({deleted} marked deleted)")
+    stored = _get_conn().execute("SELECT COUNT(*) FROM composition_fetches").fetchone()[0]
+    print(f"{stored} minifig compositions stored")
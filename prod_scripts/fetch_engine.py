@@ -0,0 +1,97 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_store import connect
+
+# Same pace as the old fixed 0.1s sleep in throttle(), but shared by all worker threads and processes
+REQUESTS_PER_SECOND = 10
+# Maximum number of requests waiting on the network at once
+MAX_IN_FLIGHT = 4
+# Bucket state shared by every scanner process on this machine
+RATE_LIMIT_FILE = "flags/rate_limit.db"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Each acquire() takes one token, blocking until
+    one has refilled if the bucket is empty.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedTokenBucket:
+    """
+    Token bucket kept in a SQLite file, so worker threads and every scanner
+    process using the same file draw from one rate. Same interface as
+    TokenBucket.
+    """
+
+    def __init__(self, rate, path, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        # opened on first use, so each process gets its own connection
+        if self._conn is None:
+            self._conn = connect(self.path, explicit_transactions=True, threaded=True)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        return self._conn
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                conn = self._get_conn()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute("SELECT tokens, updated FROM bucket WHERE id = 0").fetchone()
+                    # wall clock, since monotonic clocks aren't comparable between processes
+                    now = time.time()
+                    tokens = self.capacity if row is None else min(self.capacity, row[0] + max(now - row[1], 0) * self.rate)
+                    wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+                    if not wait:
+                        tokens -= 1
+                    conn.execute("INSERT OR REPLACE INTO bucket (id, tokens, updated) VALUES (0, ?, ?)", (tokens, now))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+rate_limiter = SharedTokenBucket(REQUESTS_PER_SECOND, RATE_LIMIT_FILE)
+
+
+def run_concurrently(fn, calls, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Runs fn(*args) for every args tuple in calls on a pool of worker threads
+    and returns the results in the same order as calls.
+    Rate limiting is left to fn (see throttle() in helper_functions).
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_in_flight, len(calls))) as pool:
+        return list(pool.map(lambda args: fn(*args), calls))
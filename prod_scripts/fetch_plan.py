@@ -0,0 +1,61 @@
+from price_cache import make_key
+
+
+class FetchPlan:
+    """
+    Collects the distinct price guide requests a batch needs so that each
+    (item, color, condition, guide_type, country) combination is fetched once
+    and the results are shared by every arbitrage check in the batch.
+    """
+
+    def __init__(self):
+        self.requests = {}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, item_type, item_id, condition, guide_type, country_code=None, color_id=None):
+        key = make_key(item_type, item_id, condition, guide_type, country_code, color_id)
+        if key not in self.requests:
+            self.requests[key] = (item_type, item_id, condition, guide_type, country_code, color_id)
+
+    def extend(self, other):
+        """
+        Adds every request of another plan, e.g. the plan for a single item.
+        """
+        for key, request in other.requests.items():
+            self.requests.setdefault(key, request)
+
+    def add_sell_thru(self, item_type, item_id, condition):
+        """
+        Adds the sold and stock guides a sell-thru rate is computed from.
+        """
+        self.add(item_type, item_id, condition, 'sold')
+        self.add(item_type, item_id, condition, 'stock')
+
+    def add_minifig(self, item_id, condition):
+        """
+        Adds everything batch_evaluator.evaluate_minifigs needs for one minifig and condition.
+        US and international prices both come from the unfiltered stock guide
+        the sell-thru rate already needs; see add_us_fallback.
+        """
+        self.add_sell_thru('MINIFIG', item_id, condition)
+
+    def add_us_fallback(self, item_id, condition):
+        """
+        Adds the US-only stock guide, needed only when the unfiltered guide
+        comes back truncated (see helper_functions.is_truncated).
+        """
+        self.add('MINIFIG', item_id, condition, 'stock', country_code='US')
+
+    def add_minifig_parts(self, item_id, condition, bom):
+        """
+        Adds everything batch_evaluator.evaluate_parts needs for one minifig and
+        condition, given its bill of materials (see bom.BomLine). Each colour
+        needs its own stock guide, but the colorless sell-thru guides are
+        planned once per part number however many colours use it.
+        """
+        self.add_sell_thru('MINIFIG', item_id, condition)
+        for line in bom:
+            self.add('PART', line.part_no, condition, 'stock', color_id=line.color_id)
+            self.add_sell_thru('PART', line.part_no, condition)
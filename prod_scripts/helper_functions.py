@@ -1,22 +1,21 @@
+import threading
 import requests
-from requests_oauthlib import OAuth1
-import os
-import time
+import pandas as pd
 from datetime import datetime
-from dotenv import load_dotenv
-load_dotenv()
-
-auth = OAuth1(
-    os.getenv("BRICKLINK_CONSUMER_KEY"),
-    os.getenv("BRICKLINK_CONSUMER_SECRET"),
-    os.getenv("BRICKLINK_TOKEN_VALUE"),
-    os.getenv("BRICKLINK_TOKEN_SECRET")
-)
-
-BASE_URL = 'https://api.bricklink.com/api/store/v1'
+from price_cache import make_key, get_cached, peek_cached, put_cached, negative_key, mark_negative, is_suppressed
+from fetch_engine import run_concurrently
+from bricklink_client import get_default_client
+from budget_ledger import ApiLimitReached
+from price_snapshots import record_snapshot
+from catalog_store import get_composition, put_composition
+from bom import build_bom
+from fetch_plan import FetchPlan
+from batch_evaluator import tiers_frame, compositions_frame, lowest_prices, evaluate_minifigs, evaluate_parts
+from call_metrics import record_lookup, timed
 
 # Global API call counter
 api_call_counter = 0
+_counter_lock = threading.Lock()
 
 def reset_api_counter():
     global api_call_counter
@@ -26,277 +25,322 @@ def get_api_call_count():
     global api_call_counter
     return api_call_counter
 
-def throttle():
-    global api_call_counter
-    api_call_counter += 1
-    time.sleep(0.1)
+# Price guide data already fetched in the current batch, keyed by request
+batch_results = {}
 
-def get_sell_thru_rate(item_type, item_id, condition):
-    url = f'{BASE_URL}/items/{item_type}/{item_id}/price'
-    params = {
-        'new_or_used': condition,  # 'N' for New, 'U' for Used
-        'currency_code': 'USD',
-        'guide_type': 'sold'
-    }
-    throttle()
-    response = requests.get(url, auth=auth, params=params)
+# (part_no, color_id) of parts whose cheapest listing changed when their stock
+# guide was refetched, for part_fanout to re-evaluate the minifigs using them
+moved_parts = set()
 
-    if response.status_code != 200:
-        print(f"Failed to get sell-thru rate for {item_id} ({condition}: {response.status_code}")
-        return None
+# When True nothing is requested from the API, so lookups are answered only by
+# batch_results (e.g. snapshots loaded by replay.py) and stored compositions
+offline = False
 
-    data = response.json()
-    six_months = data['data']['total_quantity']
+def prefetch(plan, client=None):
+    """
+    Issues every distinct request in a FetchPlan once, so batch_evaluator
+    can read every guide it needs from batch_results. Requests cut off
+    by the API limit, a network error or an error status other than 404 are
+    left out of batch_results, so only the items needing them fail is_fetched. Returns True if the API
+    limit was hit.
+    """
+    pending = [(key,) + request + (client,) for key, request in plan.requests.items() if key not in batch_results]
+    results = run_concurrently(_prefetch_one, pending)
+    limit_hit = False
+    for request, (outcome, data) in zip(pending, results):
+        if outcome == "fetched":
+            batch_results[request[0]] = data
+        limit_hit = limit_hit or outcome == "limit"
+    return limit_hit
+
+def is_fetched(plan):
+    """
+    True if every request in the plan has a result in batch_results, i.e. none
+    were cut off by the API limit or failed.
+    """
+    return all(key in batch_results for key in plan.requests)
+
+def _prefetch_one(*request):
+    try:
+        return "fetched", _request_price_data(*request)
+    except ApiLimitReached:
+        return "limit", None
+    except (requests.RequestException, ValueError) as e:
+        # ValueError covers a response body that isn't valid JSON
+        print(f"Request for {request[0]} failed: {e!r}")
+        return "failed", None
+
+def clear_batch_results():
+    batch_results.clear()
+
+def take_moved_parts():
+    """
+    Returns the parts whose price moved since the last call and forgets them.
+    """
+    with _counter_lock:
+        moved = set(moved_parts)
+        moved_parts.clear()
+    return moved
 
-    params = {
-        'new_or_used': condition,  # 'N' for New, 'U' for Used
-        'currency_code': 'USD',
-        'guide_type': 'stock'
-    }
-    throttle()
-    response = requests.get(url, auth=auth, params=params)
+def _lowest_price(data):
+    # cheapest unit price among the listings that ship to us, or None
+    return min((float(tier['unit_price']) for tier in (data or {}).get('price_detail') or []
+                if tier.get('shipping_available')), default=None)
 
-    if response.status_code != 200:
-        print(f"Failed to get sell-thru rate for {item_id} ({condition}: {response.status_code}")
-        return None
+def throttle(client=None):
+    """
+    Records the call in the shared budget ledger, raising ApiLimitReached if
+    today's budget is spent, then waits for the rate limiter. Returns the
+    client to send the request with.
+    """
+    global api_call_counter
+    client = (client or get_default_client()).checkout()
+    with _counter_lock:
+        api_call_counter += 1
+    return client
 
-    data = response.json()
-    full_stock = data['data']['total_quantity']
 
-    if full_stock == 0:
+def _request_price_data(key, item_type, item_id, condition, guide_type, country_code, color_id, client=None):
+    if offline:
+        return None
+    with timed('cache'):
+        cached = get_cached(key, guide_type)
+    if cached is not None:
+        record_lookup('price', item_type, 'hit')
+        return cached
+    # known dead items are treated like a failed request without spending a call
+    if is_suppressed(negative_key(item_type, item_id)):
+        record_lookup('price', item_type, 'negative')
         return None
-    return six_months / full_stock
-
 
-def get_price_guide(item_type, item_id, condition, country_code=None, color_id=None):
-    """
-    Gets price guide data from BrickLink for a given item.
-    If country_code is provided, only listings from that country are returned.
-    If color_id is provided, only listings for that color are returned.
-    """
-    url = f'{BASE_URL}/items/{item_type}/{item_id}/price'
     params = {
         'new_or_used': condition,  # 'N' for New, 'U' for Used
         'currency_code': 'USD',
-        'guide_type': 'stock'
+        'guide_type': guide_type
     }
     if country_code:
         params['country_code'] = country_code
     if color_id:
         params['color_id'] = color_id
-    throttle()
-    response = requests.get(url, auth=auth, params=params)
+    response = throttle(client).get(f'/items/{item_type}/{item_id}/price', params=params)
 
-    if response.status_code != 200:
-        print(f"Failed to get data for {item_id} ({condition}, country={country_code}): {response.status_code}")
+    if response.status_code == 404:
+        print(f"No {guide_type} data for {item_id} ({condition}, country={country_code}): not found")
+        mark_negative(negative_key(item_type, item_id), "not found")
         return None
-
-    data = response.json()
-    # get all tiers…
-    all_tiers = data.get('data', {}).get('price_detail', [])
-    # …but only keep those that actually ship to you
-    listings = [tier for tier in all_tiers if tier.get('shipping_available')]
-
-    if listings and item_type != "PART": 
-        print(f"Found {len(listings)} listings for {item_id} (country={country_code}, condition={condition})")
-    elif item_type != "PART":
-        print(f"No listings found for {item_id} (country={country_code}, condition={condition})")
-        return
-
-
-    # Sort listings numerically by unit_price (as float)
-    listings_sorted = sorted(listings, key=lambda x: float(x['unit_price']))
-
-    return listings_sorted
-
-def get_lowest_prices(item_id, condition, min_intl_quantity=1, min_price=0):
-    """
-    Fetch the lowest prices for a minifigure by condition (New or Used),
-    and return the cheapest price in the US and abroad that meets all requirements.
-    
-    Args:
-        item_id (str): e.g. "sw123"
-        condition (str): "N" or "U" for New or Used
-        min_intl_quantity (int): Minimum quantity required for international listing
-        min_price (float): Minimum price required for international listing
-    
-    Returns:
-        dict: { 'US': float or None, 'INTL': float or None, 'INTL Quantity': int or None }
-    """
-    # Get US price
-    us_listings = get_price_guide('MINIFIG', item_id, condition, country_code='US')
-    us_price = None
-    if us_listings:
-        us_price = float(us_listings[0]['unit_price'])
-
-    # Get International price (any country except US)
-    intl_listings = get_price_guide('MINIFIG', item_id, condition)
-    intl_price = None
-    intl_quantity = None
-    
-    if intl_listings:
-        # Find the first listing that is NOT from the US AND meets all requirements
-        for listing in intl_listings:
-            if listing.get('seller_country_code', '') != 'US':
-                listing_price = float(listing['unit_price'])
-                listing_quantity = int(listing['quantity'])
-                
-                # Check if this listing meets all requirements
-                if (listing_quantity >= min_intl_quantity and 
-                    listing_price >= min_price):
-                    intl_price = listing_price
-                    intl_quantity = listing_quantity
-                    break
-
-    return {'US': us_price, 'INTL': intl_price, 'INTL Quantity': intl_quantity}
-
-def fetch_minifig_parts_with_colors(item_id):
+    if response.status_code != 200:
+        # 5xx, a 429 that outlasted the retries, etc.: the guide is missing, not empty
+        raise requests.HTTPError(f"HTTP {response.status_code} getting {guide_type} data for {item_id} "
+                                 f"({condition}, country={country_code})", response=response)
+
+    with timed('json'):
+        data = response.json().get('data', {})
+    if item_type == 'PART' and guide_type == 'stock' and color_id:
+        with timed('cache'):
+            previous = peek_cached(key)
+        if previous is not None and _lowest_price(previous) != _lowest_price(data):
+            with _counter_lock:
+                moved_parts.add((item_id, color_id))
+    with timed('cache'):
+        put_cached(key, guide_type, data)
+    record_snapshot(item_type, item_id, condition, guide_type, country_code, color_id, data)
+    return data
+
+
+def is_truncated(data):
     """
-    Fetches all parts for the given minifigure and returns
-    a list of (part_no, color_id) tuples.
-    
-    :param item_id: e.g. "sw0239"
-    :return: [("970c00", 48), ("42446", 85), ...]
+    True if a stock guide's 'data' block lists fewer lots than its
+    unit_quantity says exist, so some listings (e.g. the cheapest US ones)
+    may be missing from it.
     """
-    url = f"{BASE_URL}/items/MINIFIG/{item_id}/subsets"
-    params = {"break_minifigs": "true"}
-    throttle()  # Count this API call
-    resp = requests.get(url, auth=auth, params=params)
-    if resp.status_code != 200:
-        raise RuntimeError(f"Failed to fetch subsets for {item_id}: HTTP {resp.status_code}")
+    return data is not None and len(data.get('price_detail') or []) < (data.get('unit_quantity') or 0)
 
-    data = resp.json().get("data", [])
-    if not data:
-        return []
 
+def _parse_subsets(data):
+    """
+    Turns a /subsets response into [(part_no, color_id, quantity), ...].
+    """
     parts = []
-    for subset in data:
+    for subset in data or []:
         for entry in subset.get("entries", []):
             item = entry.get("item", {})
             no = item.get("no")
             color_id = entry.get("color_id")
             # only include entries where we got both a part no and a color
             if no is not None and color_id is not None:
-                parts.append((no, color_id))
+                parts.append((no, color_id, entry.get("quantity") or 1))
+    return parts
 
+
+def fetch_minifig_composition(item_id, client=None):
+    """
+    Returns a minifig's [(part_no, color_id, quantity), ...] from the
+    composition graph in the catalog store, fetching /subsets only when the
+    minifig has never been seen or its composition is older than
+    COMPOSITION_TTL. Subsets left in the price cache by earlier runs are
+    moved into the graph without a call.
+    """
+    with timed('cache'):
+        parts = get_composition(item_id, ignore_ttl=offline)
+    if parts is not None:
+        record_lookup('subsets', 'MINIFIG', 'hit')
+        return parts
+
+    data = get_cached(make_key('MINIFIG', item_id, None, 'subsets'), 'subsets', ignore_ttl=True)
+    if data is None and offline:
+        raise RuntimeError(f"No cached subsets for {item_id} in offline mode")
+    if data is None:
+        params = {"break_minifigs": "true"}
+        resp = throttle(client).get(f"/items/MINIFIG/{item_id}/subsets", params=params)
+        if resp.status_code != 200:
+            if resp.status_code == 404:
+                mark_negative(negative_key('MINIFIG', item_id), "not found")
+            raise RuntimeError(f"Failed to fetch subsets for {item_id}: HTTP {resp.status_code}")
+        with timed('json'):
+            data = resp.json().get("data", [])
+
+    parts = _parse_subsets(data)
+    if not offline:
+        put_composition(item_id, parts)
+        if not parts:
+            mark_negative(negative_key('MINIFIG', item_id, 'subsets'), "no parts")
     return parts
 
 
-def get_prices_parts(item_id, condition):
+def fetch_minifig_bom(item_id, client=None):
     """
-    Get the prices for a minifig and its parts that meet the specified thresholds.
+    Fetches the bill of materials of the given minifigure: one BomLine per
+    part and colour, with the number of copies the minifig contains.
+
+    :param item_id: e.g. "sw0239"
+    :param client: shared BrickLinkClient, defaults to get_default_client()
+    :return: [BomLine("970c00", 48, 1), BomLine("3626c", 85, 2), ...]
     """
-    part_ids = fetch_minifig_parts_with_colors(item_id)
-    all_minifigs = get_price_guide('MINIFIG', item_id, condition)
-    part_listings = {}
-    for (part_id, color_id) in part_ids:
-        part_listings[part_id] = get_price_guide('PART', part_id, condition, color_id=color_id)
-    return (all_minifigs, part_listings)
+    return build_bom(fetch_minifig_composition(item_id, client))
+
+
+# Single-item versions of the batch scanners' checks, for scripts and
+# notebooks. Each plans the guides it needs, fetches them with prefetch (so
+# they are shared through batch_results and the price cache) and evaluates
+# them with batch_evaluator, so they follow exactly the scanners' rules.
+
+def _fetch(plan, client=None):
+    if prefetch(plan, client):
+        raise ApiLimitReached("Daily API limit reached")
 
 
-def identify_price_arbitrage(item_id, condition, discount_rate, sell_thru_rate, min_intl_quantity=1, min_price=0):
+def _minifig_guides(item_id, condition, client=None):
     """
-    Identify arbitrage opportunities based on the lowest prices.
-    
-    Args:
-        item_id (str): e.g. "sw123"
-        condition (str): "N" or "U" for New or Used
-        discount_rate (float): Maximum ratio of international to US price (e.g., 0.6 for 60%)
-        sell_thru_rate (float): Minimum sell-through rate required
-        min_intl_quantity (int): Minimum quantity required for international listing
-        min_price (float): Minimum price required for international listing
-    
-    Returns:
-        dict: Arbitrage opportunity data if found, else None
+    Fetches the guides the minifig rules need for one minifig and condition,
+    adding the US-only guide when the unfiltered one is truncated.
+    """
+    plan = FetchPlan()
+    plan.add_minifig(item_id, condition)
+    _fetch(plan, client)
+    if is_truncated(batch_results.get(make_key('MINIFIG', item_id, condition, 'stock'))):
+        fallback = FetchPlan()
+        fallback.add_us_fallback(item_id, condition)
+        _fetch(fallback, client)
+        plan.extend(fallback)
+    return tiers_frame(plan.requests, batch_results)
+
+
+def get_sell_thru_rate(item_type, item_id, condition, client=None):
     """
-    prices = get_lowest_prices(item_id, condition, min_intl_quantity, min_price)
-    us_price = prices.get('US')
-    intl_price = prices.get('INTL')
-    intl_quantity = prices.get('INTL Quantity')
+    Six month sold quantity over current stock quantity, or None if either
+    guide couldn't be fetched or nothing is in stock.
+    """
+    plan = FetchPlan()
+    plan.add_sell_thru(item_type, item_id, condition)
+    _fetch(plan, client)
+    sold_data = batch_results.get(make_key(item_type, item_id, condition, 'sold'))
+    stock_data = batch_results.get(make_key(item_type, item_id, condition, 'stock'))
+    if sold_data is None or stock_data is None or not stock_data.get('total_quantity'):
+        return None
+    return sold_data['total_quantity'] / stock_data['total_quantity']
 
-    calc_sell_thru_rate = get_sell_thru_rate('MINIFIG', item_id, condition)
 
-    if us_price is None or intl_price is None or calc_sell_thru_rate is None:
+def get_price_guide(item_type, item_id, condition, country_code=None, color_id=None, client=None):
+    """
+    Gets price guide data from BrickLink for a given item: the listings that
+    ship to you, sorted by unit price.
+    If country_code is provided, only listings from that country are returned.
+    If color_id is provided, only listings for that color are returned.
+    """
+    plan = FetchPlan()
+    plan.add(item_type, item_id, condition, 'stock', country_code=country_code, color_id=color_id)
+    _fetch(plan, client)
+    data = batch_results.get(make_key(item_type, item_id, condition, 'stock', country_code, color_id))
+    if data is None:
         return None
+    listings = [tier for tier in data.get('price_detail') or [] if tier.get('shipping_available')]
+    if listings and item_type != "PART":
+        print(f"Found {len(listings)} listings for {item_id} (country={country_code}, condition={condition})")
+    elif item_type != "PART":
+        print(f"No listings found for {item_id} (country={country_code}, condition={condition})")
+        return None
+    return sorted(listings, key=lambda tier: float(tier['unit_price']))
+
 
-    # Arbitrage condition: international price meets discount rate AND sell-through rate requirement
-    if intl_price <= discount_rate * us_price and calc_sell_thru_rate >= sell_thru_rate:
-        return {
-            'ItemID': item_id,
-            'Condition': condition,
-            'Intl Price': round(intl_price, 2),
-            'US Price': round(us_price, 2),
-            'Intl Quantity': intl_quantity,
-            'Sell Thru Rate': round(calc_sell_thru_rate, 2),
-            'Timestamp': datetime.utcnow().isoformat()
-        }
-    
-    return None
-
-def identify_price_arbitrage_parts(item_id, condition, discount_rate, sell_thru_rate_minifig, sell_thru_rate_part, min_minifig_quantity, min_minifig_price):
+def get_lowest_prices(item_id, condition, min_intl_quantity=1, min_price=0, client=None):
     """
-    Identify arbitrage opportunities by breaking minifigs into parts or vice versa.
-    Returns: opportunities_list or None
+    Fetch the lowest prices for a minifigure by condition (New or Used),
+    and return the cheapest price in the US and abroad that meets all requirements.
+
+    Returns:
+        dict: { 'US': float or None, 'INTL': float or None, 'INTL Quantity': int or None }
+    """
+    prices = lowest_prices(_minifig_guides(item_id, condition, client), min_intl_quantity, min_price)
+    prices = prices[(prices['item_id'] == item_id) & (prices['condition'] == condition)]
+    if prices.empty:
+        return {'US': None, 'INTL': None, 'INTL Quantity': None}
+    row = prices.iloc[0]
+    return {'US': None if pd.isna(row['us_price']) else float(row['us_price']),
+            'INTL': None if pd.isna(row['intl_price']) else float(row['intl_price']),
+            'INTL Quantity': None if pd.isna(row['intl_quantity']) else int(row['intl_quantity'])}
+
+
+def get_prices_parts(item_id, condition, client=None):
     """
-    minifig_sell_thru = get_sell_thru_rate('MINIFIG', item_id, condition)
-    all_minifigs, parts_dict = get_prices_parts(item_id, condition)
-    if not all_minifigs or float(all_minifigs[0]['unit_price']) < min_minifig_price or not minifig_sell_thru:
+    Get the listings of a minifig and of each line of its bill of materials,
+    as (minifig listings, {BomLine: part listings}).
+    """
+    bom = fetch_minifig_bom(item_id, client)
+    plan = FetchPlan()
+    plan.add_minifig_parts(item_id, condition, bom)
+    _fetch(plan, client)
+    all_minifigs = get_price_guide('MINIFIG', item_id, condition, client=client)
+    part_listings = {line: get_price_guide('PART', line.part_no, condition, color_id=line.color_id, client=client)
+                     for line in bom}
+    return (all_minifigs, part_listings)
+
+
+def identify_price_arbitrage(item_id, condition, discount_rate, sell_thru_rate, min_intl_quantity=1, min_price=0, client=None):
+    """
+    Identify arbitrage opportunities based on the lowest prices.
+    Returns: the opportunity as a dict if found, else None
+    """
+    parameters = {'discount_rate': discount_rate, 'sell_thru_rate': sell_thru_rate,
+                  'min_intl_quantity': min_intl_quantity, 'min_price': min_price}
+    result = evaluate_minifigs(_minifig_guides(item_id, condition, client), [parameters])
+    if result.empty:
         return None
+    opportunity = result.drop(columns='param_set').to_dict('records')[0]
+    opportunity['Timestamp'] = datetime.utcnow().isoformat()
+    return opportunity
 
-    # check break apart first
-    dicts_to_return = []
-    for minifig in all_minifigs:
-        if int(minifig['quantity']) >= min_minifig_quantity:
-            total_parts_price = 0
-            parts = []
-            for part_id, part_listings in parts_dict.items():
-                if part_listings and len(part_listings) > 0:
-                    part_sell_thru = get_sell_thru_rate('PART', part_id, condition)
-                    if part_sell_thru and part_sell_thru >= sell_thru_rate_part:
-                        total_parts_price += float(part_listings[0]['unit_price'])
-                        parts.append(part_id)
-            if float(minifig['unit_price']) <= discount_rate * total_parts_price:
-                dicts_to_return.append({
-                    'ItemID': item_id,
-                    'Condition': condition,
-                    'Break or Build': "Break",
-                    'Parts Considered': ", ".join(parts),
-                    'Minifig Price': round(float(minifig['unit_price']), 2),
-                    'Minifig Sell Thru Rate': round(minifig_sell_thru, 2),
-                    'Minifig Quantity': int(minifig['quantity']),
-                    'Parts Combined Price': round(total_parts_price, 2)
-                })
-        break
-
-    # check build next
-    minifig_price = float(all_minifigs[0]['unit_price'])
-    
-    if minifig_sell_thru >= sell_thru_rate_minifig:
-        total_build_cost = 0
-        parts_used = []
-        failed_to_find = False
-        for part_id, part_listings in parts_dict.items():
-            if failed_to_find:
-                break
-            if part_listings and len(part_listings) > 0:
-                for i in range(len(part_listings)):
-                    part_entry = part_listings[i]
-                    if int(part_entry['quantity']) >= min_minifig_quantity:
-                        total_build_cost += float(part_entry['unit_price'])
-                        parts_used.append(part_id)
-                        break
-                    elif i == len(part_listings) - 1:
-                        failed_to_find = True
-        if total_build_cost > 0 and total_build_cost <= discount_rate * minifig_price and not failed_to_find:
-            dicts_to_return.append({
-                    'ItemID': item_id,
-                    'Condition': condition,
-                    'Break or Build': "Build",
-                    'Parts Considered': ", ".join(parts_used),
-                    'Minifig Price': round(minifig_price, 2),
-                    'Minifig Sell Thru Rate': round(minifig_sell_thru, 2),
-                    'Minifig Quantity': min_minifig_quantity,
-                    'Parts Combined Price': round(total_build_cost, 2)
-            })
-    return dicts_to_return if dicts_to_return else None
 
+def identify_price_arbitrage_parts(item_id, condition, discount_rate, sell_thru_rate_minifig, sell_thru_rate_part, min_minifig_quantity, min_minifig_price, client=None):
+    """
+    Identify arbitrage opportunities by breaking minifigs into parts or vice versa.
+    Returns: opportunities_list or None
+    """
+    bom = fetch_minifig_bom(item_id, client)
+    plan = FetchPlan()
+    plan.add_minifig_parts(item_id, condition, bom)
+    _fetch(plan, client)
+    parameters = {'discount_rate': discount_rate, 'sell_thru_rate_minifig': sell_thru_rate_minifig,
+                  'sell_thru_rate_part': sell_thru_rate_part, 'min_minifig_quantity': min_minifig_quantity,
+                  'min_minifig_price': min_minifig_price}
+    result = evaluate_parts(tiers_frame(plan.requests, batch_results), compositions_frame({item_id: bom}), [parameters])
+    return result.drop(columns='param_set').to_dict('records') or None
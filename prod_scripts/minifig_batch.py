@@ -1,133 +1,136 @@
-from requests_oauthlib import OAuth1
-import os
-import csv
 import sys
-import pandas as pd
+import time
 from datetime import datetime
-from helper_functions import identify_price_arbitrage
-from dotenv import load_dotenv
-load_dotenv()
+from helper_functions import batch_results, prefetch, is_fetched, is_truncated, clear_batch_results, reset_api_counter, get_api_call_count
+from batch_evaluator import tiers_frame, item_metrics, stock_status, evaluate_minifigs
+from fetch_plan import FetchPlan
+from price_cache import make_key
+from bricklink_client import get_default_client
+from price_cache import get_cache_stats
+from price_snapshots import flush_if_due as flush_snapshots_if_due
+from batch_stats import next_batch_size, record_batch
+from opportunity_store import export_csv
+from batch_common import select_category, load_minifig_ids, save_opportunities, drop_suppressed, update_negative_cache
+from scan_scheduler import pick_batch, record_scans
+from call_metrics import configure as configure_metrics, start_batch, finish_batch, timed
 
 DISCOUNT_RATE = 0.6
 SELL_THRU_RATE = 0.4
-MIN_INTL_QUANTITY = 1 
+MIN_INTL_QUANTITY = 1
 MIN_PRICE = 0.25
-
-auth = OAuth1(
-    os.getenv("BRICKLINK_CONSUMER_KEY"),
-    os.getenv("BRICKLINK_CONSUMER_SECRET"),
-    os.getenv("BRICKLINK_TOKEN_VALUE"),
-    os.getenv("BRICKLINK_TOKEN_SECRET")
-)
-
-minifig_ids = []
-working_file = 'processed_data/all_minifigs.csv'
-if os.path.exists('processed_data/all_minifigs_filtered.csv'):
-    working_file = 'processed_data/all_minifigs_filtered.csv'
-progress_file = "flags/minifig_last_index.txt"
-
-if "-sw" in sys.argv:
-    working_file = 'processed_data/star_wars_minifigs.csv'
-    progress_file = "flags/sw_minifig_last_index.txt"
-elif "-sh" in sys.argv:
-    working_file = 'processed_data/super_hero_minifigs.csv'
-    progress_file = "flags/sh_minifig_last_index.txt"
-elif "-col" in sys.argv:
-    working_file = 'processed_data/collectible_minifigs.csv'
-    progress_file = "flags/col_minifig_last_index.txt"
-with open(working_file, newline='') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        minifig_ids.append(row['item_id'])
-
-
-if os.path.exists(progress_file):
-    with open(progress_file, "r") as f:
-        start_idx = int(f.read().strip())
-else:
-    start_idx = 0
-
-n = len(minifig_ids)
-batch_size = 25
-arbitrage_data = []
-api_limit_hit = False
-
-# Only process a batch, wrapping around if needed
-for offset in range(batch_size):
-    idx = (start_idx + offset) % n
-    item_id = minifig_ids[idx]
-    for condition in ['N', 'U']:
-        try:
-            arbitrage = identify_price_arbitrage(item_id=item_id, 
-                                                 condition=condition, 
-                                                 discount_rate=DISCOUNT_RATE,
-                                                 sell_thru_rate=SELL_THRU_RATE,
-                                                 min_intl_quantity=MIN_INTL_QUANTITY,
-                                                 min_price=MIN_PRICE)
-            if arbitrage:
-                arbitrage_data.append(arbitrage)
-        except Exception as e:
-            if "api limit" in str(e).lower():
-                print(f"API limit hit at index {idx}. Saving progress and flag.")
-                with open(progress_file, "w") as f:
-                    f.write(str(idx))
-                api_limit_hit = True
-                break
-            else:
-                print(f"Error with {item_id} ({condition}): {e}")
-    if api_limit_hit:
-        break
-
-# If finished batch without hitting API limit, update last index
-if not api_limit_hit:
-    next_idx = (start_idx + batch_size) % n
-    with open(progress_file, "w") as f:
-        f.write(str(next_idx))
-
-# Create DataFrame and save
-df_arbitrage = pd.DataFrame(arbitrage_data)
-
-# Load existing opportunities
-csv_path = "arbitrage/minifig_opportunities.csv"
-if os.path.exists(csv_path):
-    df_existing = pd.read_csv(csv_path)
-else:
-    df_existing = pd.DataFrame(columns=["ItemID", "Condition", "Intl Price", "US Price", "Intl Quantity", "Sell Thru Rate", "Timestamp"])
-
-# Remove duplicates from existing
-if not df_arbitrage.empty:
-    # Ensure columns match
-    df_new = df_arbitrage[df_existing.columns]
-    # Remove any existing rows with same ItemID and Condition
-    mask = ~df_existing.set_index(["ItemID", "Condition"]).index.isin(
-        df_new.set_index(["ItemID", "Condition"]).index
-    )
-    df_existing = df_existing[mask]
-    # Append new data
-    df_result = pd.concat([df_existing, df_new], ignore_index=True)
-    # Save (append mode)
-    df_result.to_csv(csv_path, index=False)
-    print(f"Found {len(df_new)} arbitrage opportunities. Appended to CSV.")
-else:
-    print("No new arbitrage opportunities found.")
-
-# Update API call count
-api_call_count_file = "flags/api_call_count.txt"
-today_str = datetime.now().strftime("%Y-%m-%d")
-calls_today = 0
-
-if os.path.exists(api_call_count_file):
+PARAMETERS = {
+    'discount_rate': DISCOUNT_RATE,
+    'sell_thru_rate': SELL_THRU_RATE,
+    'min_intl_quantity': MIN_INTL_QUANTITY,
+    'min_price': MIN_PRICE
+}
+
+MIN_BATCH_SIZE = 5
+MAX_BATCH_SIZE = 200
+# Used until a category has batch history to size from
+BATCH_SIZE = 25
+STATS_PREFIX = ""
+TABLE = "minifig_opportunities"
+
+
+def scan_batch(minifig_ids, client, batch_size=None, category="all", steal_ids=()):
+    """
+    Scans the batch_size minifigs the scan scheduler ranks highest.
+    If batch_size is None it is sized from the category's recorded calls and
+    time per item. steal_ids are other workers' minifigs this one may take
+    over (see scan_scheduler.pick_batch). Returns (arbitrage_data, api_limit_hit).
+    """
+    stats_category = f"{STATS_PREFIX}{category}"
+    if batch_size is None:
+        batch_size = next_batch_size(stats_category, client.remaining_today(), BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE)
+    # Reset API counter at start of batch
+    reset_api_counter()
+    batch_ids = pick_batch(TABLE, drop_suppressed(minifig_ids), batch_size, drop_suppressed(steal_ids))
+    if not batch_ids:
+        print("Every minifig is already claimed by another scanner")
+        return [], False
+    print(f"Scanning {len(batch_ids)} minifigs, highest priority first")
+    start_batch(TABLE)
+    started = time.time()
+    arbitrage_data = []
+
+    # Plan the whole batch up front so guides shared between checks are fetched once
+    plan = FetchPlan()
+    item_plans = []
+    for item_id in batch_ids:
+        item_plan = FetchPlan()
+        for condition in ['N', 'U']:
+            item_plan.add_minifig(item_id, condition)
+        item_plans.append(item_plan)
+        plan.extend(item_plan)
+    print(f"Planned {len(plan)} distinct price guide requests for this batch")
+    # Hold the budget this batch may need so concurrent scanners can't spend it
+    client.reserve(len(plan))
+
+    api_limit_hit = False
+    scanned = 0
     try:
-        with open(api_call_count_file, "r") as f:
-            lines = f.readlines()
-        file_date = lines[0].strip() if len(lines) > 0 else ""
-        file_count = int(lines[1].strip()) if len(lines) > 1 and lines[1].strip().isdigit() else 0
-        if file_date == today_str:
-            calls_today = file_count
-    except Exception:
-        calls_today = 0
-
-calls_today += batch_size * 2 * 4  # batch size items, 2 conditions (N, U), 4 calls per item
-
-with open(api_call_count_file, "w") as f:
-    f.write(f"{today_str}\n{calls_today}\n")
\ No newline at end of file
+        api_limit_hit = prefetch(plan, client)
+        # US prices come from the unfiltered guides; only truncated ones need the US-only guide too
+        fallback = FetchPlan()
+        for item_id, item_plan in zip(batch_ids, item_plans):
+            for condition in ['N', 'U']:
+                if is_truncated(batch_results.get(make_key('MINIFIG', item_id, condition, 'stock'))):
+                    item_plan.add_us_fallback(item_id, condition)
+                    fallback.add_us_fallback(item_id, condition)
+        if len(fallback):
+            print(f"{len(fallback)} stock guides were truncated; fetching their US-only guides")
+            api_limit_hit = prefetch(fallback, client) or api_limit_hit
+        # Only items whose guides were all fetched count as scanned; the rest go back to the schedule
+        scanned_ids = []
+        scanned_plan = FetchPlan()
+        for item_id, item_plan in zip(batch_ids, item_plans):
+            if is_fetched(item_plan):
+                scanned_ids.append(item_id)
+                scanned_plan.extend(item_plan)
+        scanned = len(scanned_ids)
+        if scanned < len(batch_ids):
+            reason = "API limit hit" if api_limit_hit else "requests failed"
+            print(f"{reason}: {len(batch_ids) - scanned} minifigs go back to the schedule.")
+
+        # Evaluate every scanned minifig at once from the batch's guides
+        with timed('evaluate'):
+            guides = tiers_frame(scanned_plan.requests, batch_results)
+            metrics = item_metrics(guides, scanned_ids)
+        with timed('schedule'):
+            record_scans(TABLE, batch_ids, metrics)
+            update_negative_cache(stock_status(guides, scanned_ids))
+        with timed('evaluate'):
+            result = evaluate_minifigs(guides, [PARAMETERS])
+        timestamp = datetime.utcnow().isoformat()
+        for opportunity in result.drop(columns='param_set').to_dict('records'):
+            opportunity['Timestamp'] = timestamp
+            arbitrage_data.append(opportunity)
+    finally:
+        clear_batch_results()
+        client.release()
+        with timed('snapshots'):
+            flush_snapshots_if_due()
+        finish_batch()
+
+    if not scanned and not api_limit_hit:
+        # e.g. the API is down; raised so run_scanner backs off instead of moving on
+        raise RuntimeError(f"Every request for the {len(batch_ids)} minifigs in this batch failed")
+    record_batch(stats_category, scanned, get_api_call_count(), time.time() - started)
+    return arbitrage_data, api_limit_hit
+
+
+if __name__ == "__main__":
+    configure_metrics(sys.argv)
+    client = get_default_client()
+    category = select_category(sys.argv)
+    minifig_ids = load_minifig_ids(sys.argv)
+
+    arbitrage_data, api_limit_hit = scan_batch(minifig_ids, client, category=category)
+    save_opportunities(arbitrage_data, TABLE)
+    export_csv(TABLE)
+
+    print(f"API calls made in this batch: {get_api_call_count()} ({client.calls_today()} today)")
+
+    cache_stats = get_cache_stats()
+    print(f"Price cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['entries']} entries stored)")
@@ -0,0 +1,106 @@
+import csv
+import os
+from sqlite_store import connect
+
+STORE_FILE = "arbitrage/opportunities.db"
+
+# table -> (columns, primary key, columns whose rows are all replaced by a new scan)
+TABLES = {
+    "minifig_opportunities": (
+        ["ItemID", "Condition", "Intl Price", "US Price", "Intl Quantity", "Sell Thru Rate", "Timestamp"],
+        ["ItemID", "Condition"],
+        ["ItemID", "Condition"]
+    ),
+    "parts_minifig_opportunities": (
+        ["ItemID", "Condition", "Break or Build", "Parts Considered",
+         "Minifig Price", "Minifig Sell Thru Rate", "Minifig Quantity",
+         "Parts Combined Price"],
+        ["ItemID", "Condition", "Break or Build"],
+        ["ItemID", "Condition"]
+    )
+}
+
+_conn = None
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(STORE_FILE)
+        for table, (columns, key_columns, _) in TABLES.items():
+            exists = _conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            _conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                + ", ".join(_quote(c) for c in columns)
+                + f", PRIMARY KEY ({', '.join(_quote(c) for c in key_columns)}))"
+            )
+            if not exists:
+                _import_csv(_conn, table, f"arbitrage/{table}.csv")
+        _conn.commit()
+    return _conn
+
+
+def _import_csv(conn, table, csv_path):
+    """
+    Seeds a new table from the CSV the batch scripts used to maintain.
+    """
+    if not os.path.exists(csv_path):
+        return
+    columns = TABLES[table][0]
+    with open(csv_path, newline='') as csvfile:
+        rows = [[row.get(c) for c in columns] for row in csv.DictReader(csvfile)]
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' for _ in columns)})", rows
+    )
+    print(f"Imported {len(rows)} existing rows from {csv_path}")
+
+
+def upsert(table, rows):
+    """
+    Inserts rows into table in a single transaction. Existing rows for the same
+    ItemID and Condition are replaced, so a rescan clears stale opportunities.
+    """
+    if not rows:
+        return
+    columns, _, replace_columns = TABLES[table]
+    conn = _get_conn()
+    with conn:
+        replaced = {tuple(row[c] for c in replace_columns) for row in rows}
+        conn.executemany(
+            f"DELETE FROM {table} WHERE " + " AND ".join(f"{_quote(c)} = ?" for c in replace_columns),
+            list(replaced)
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' for _ in columns)})",
+            [[row.get(c) for c in columns] for row in rows]
+        )
+
+
+def export_csv(table, csv_path=None):
+    """
+    Writes table out in the existing CSV format. The file is written to a
+    temporary path and renamed into place, so readers never see a partial file.
+    """
+    columns = TABLES[table][0]
+    csv_path = csv_path or f"arbitrage/{table}.csv"
+    tmp_path = csv_path + ".tmp"
+    rows = _get_conn().execute(f"SELECT * FROM {table} ORDER BY rowid")
+    with open(tmp_path, "w", newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    os.replace(tmp_path, csv_path)
+
+
+def count(table):
+    return _get_conn().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+if __name__ == "__main__":
+    for table in TABLES:
+        export_csv(table)
+        print(f"Exported {count(table)} rows to arbitrage/{table}.csv")
@@ -0,0 +1,76 @@
+from catalog_store import get_composition, minifigs_using
+from price_cache import peek_cached
+from fetch_plan import FetchPlan
+from batch_evaluator import tiers_frame, compositions_frame, evaluate_parts
+from bom import build_bom
+
+# Cached guides older than this aren't trusted to re-price a minifig
+MAX_GUIDE_AGE = 24 * 60 * 60
+# Most minifigs re-evaluated after one batch, so a very common part can't stall it
+MAX_AFFECTED = 500
+
+
+def affected_minifigs(moved_parts, skip_ids=()):
+    """
+    Returns the minifigs in the composition graph that use any of the
+    (part_no, color_id) pairs in moved_parts, leaving out skip_ids.
+    """
+    skip = set(skip_ids)
+    affected = {}
+    for part_no, color_id in sorted(moved_parts):
+        for item_id in minifigs_using(part_no, color_id):
+            if item_id not in skip:
+                affected[item_id] = True
+    return list(affected)
+
+
+def _cached_item(item_id):
+    """
+    Returns (bom, plan, results) for a minifig whose composition and every
+    guide the parts rules need are cached within MAX_GUIDE_AGE, else None.
+    """
+    composition = get_composition(item_id, ignore_ttl=True)
+    if not composition:
+        return None
+    bom = build_bom(composition)
+    plan = FetchPlan()
+    for condition in ['N', 'U']:
+        plan.add_minifig_parts(item_id, condition, bom)
+    results = {}
+    for key in plan.requests:
+        data = peek_cached(key, MAX_GUIDE_AGE)
+        if data is None:
+            return None
+        results[key] = data
+    return bom, plan, results
+
+
+def reevaluate_affected(moved_parts, parameters, skip_ids=()):
+    """
+    Re-runs the break/build rules for the minifigs using a part whose price
+    moved, from cached prices only, so no API calls are made. Minifigs with a
+    guide missing from the cache (or too old) are left for the scanner.
+    Returns the opportunities found, like scan_batch.
+    """
+    affected = affected_minifigs(moved_parts, skip_ids)[:MAX_AFFECTED]
+    if not affected:
+        return []
+
+    plan = FetchPlan()
+    results = {}
+    parts_by_item = {}
+    for item_id in affected:
+        cached = _cached_item(item_id)
+        if cached is None:
+            continue
+        parts_by_item[item_id], item_plan, item_results = cached
+        plan.extend(item_plan)
+        results.update(item_results)
+    print(f"{len(moved_parts)} part prices moved; re-evaluated {len(parts_by_item)} of the "
+          f"{len(affected)} other minifigs using them from cached prices")
+    if not parts_by_item:
+        return []
+
+    guides = tiers_frame(plan.requests, results)
+    result = evaluate_parts(guides, compositions_frame(parts_by_item), [parameters])
+    return result.drop(columns='param_set').to_dict('records')
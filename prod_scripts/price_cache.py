@@ -0,0 +1,198 @@
+import json
+import time
+import threading
+from sqlite_store import connect
+
+CACHE_FILE = "flags/price_cache.db"
+
+# How long (in seconds) a cached response stays fresh, per guide_type
+CACHE_TTL = {
+    'stock': 6 * 60 * 60,         # current listings move quickly
+    'sold': 24 * 60 * 60,         # six month sales history barely changes in a day
+    'subsets': 30 * 24 * 60 * 60  # minifig compositions almost never change
+}
+DEFAULT_TTL = 6 * 60 * 60
+
+# Maximum number of cached responses before least recently used ones are evicted
+MAX_ENTRIES = 200000
+
+# Eviction needs a COUNT(*), so only check the size every so many writes
+EVICTION_CHECK_INTERVAL = 500
+
+# Items that came back missing (404), with no stock or with no parts aren't
+# asked for again for NEGATIVE_TTL seconds, doubling each time they come back
+# the same way, up to NEGATIVE_MAX_TTL
+NEGATIVE_TTL = 24 * 60 * 60
+NEGATIVE_MAX_TTL = 90 * 24 * 60 * 60
+
+_conn = None
+_lock = threading.RLock()
+_writes_since_check = 0
+cache_hits = 0
+cache_misses = 0
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(CACHE_FILE, threaded=True)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                cache_key TEXT PRIMARY KEY,
+                guide_type TEXT NOT NULL,
+                data TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS negative (
+                item_key TEXT PRIMARY KEY,
+                reason TEXT NOT NULL,
+                failures INTEGER NOT NULL,
+                retry_after REAL NOT NULL
+            )
+        """)
+        _conn.commit()
+    return _conn
+
+
+def make_key(item_type, item_id, condition, guide_type, country_code=None, color_id=None):
+    """
+    Builds the cache key for a request from the full request tuple.
+    """
+    return f"{item_type}|{item_id}|{condition}|{guide_type}|{country_code or ''}|{color_id or ''}"
+
+
+def get_cached(key, guide_type, ignore_ttl=False):
+    """
+    Returns the cached response data for key, or None if it is missing or older
+    than the TTL for its guide_type (unless ignore_ttl is set).
+    """
+    global cache_hits, cache_misses
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute("SELECT data, fetched_at FROM responses WHERE cache_key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (not ignore_ttl and now - row[1] > CACHE_TTL.get(guide_type, DEFAULT_TTL)):
+            cache_misses += 1
+            return None
+        conn.execute("UPDATE responses SET last_access = ? WHERE cache_key = ?", (now, key))
+        conn.commit()
+        cache_hits += 1
+    return json.loads(row[0])
+
+
+def peek_cached(key, max_age=None):
+    """
+    Returns the cached response data for key if it was fetched within max_age
+    seconds (any age if None), without counting a hit or miss or refreshing
+    its last access.
+    """
+    with _lock:
+        row = _get_conn().execute("SELECT data, fetched_at FROM responses WHERE cache_key = ?", (key,)).fetchone()
+    if row is None or (max_age is not None and time.time() - row[1] > max_age):
+        return None
+    return json.loads(row[0])
+
+
+def put_cached(key, guide_type, data):
+    """
+    Stores response data for key and evicts the least recently used entries
+    once the cache grows past MAX_ENTRIES.
+    """
+    global _writes_since_check
+    with _lock:
+        conn = _get_conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (cache_key, guide_type, data, fetched_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, guide_type, json.dumps(data), now, now)
+        )
+        _writes_since_check += 1
+        if _writes_since_check >= EVICTION_CHECK_INTERVAL:
+            _writes_since_check = 0
+            count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > MAX_ENTRIES:
+                conn.execute(
+                    "DELETE FROM responses WHERE cache_key IN "
+                    "(SELECT cache_key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (count - MAX_ENTRIES,)
+                )
+        conn.commit()
+
+
+def negative_key(item_type, item_id, guide_type=None):
+    """
+    Builds the negative cache key for an item, optionally for one guide_type
+    only (e.g. 'subsets' for minifigs without parts).
+    """
+    return f"{item_type}|{item_id}|{guide_type or ''}"
+
+
+def mark_negative(item_key, reason):
+    """
+    Suppresses item_key for NEGATIVE_TTL seconds, doubled for every time in a
+    row it has been marked before. Marking an item that is still suppressed
+    (e.g. several guides of one item 404ing in the same batch) counts once.
+    """
+    with _lock:
+        conn = _get_conn()
+        now = time.time()
+        row = conn.execute("SELECT failures, retry_after FROM negative WHERE item_key = ?", (item_key,)).fetchone()
+        if row and row[1] > now:
+            return
+        failures = row[0] + 1 if row else 1
+        backoff = min(NEGATIVE_TTL * 2 ** (failures - 1), NEGATIVE_MAX_TTL)
+        conn.execute(
+            "INSERT OR REPLACE INTO negative (item_key, reason, failures, retry_after) VALUES (?, ?, ?, ?)",
+            (item_key, reason, failures, now + backoff)
+        )
+        conn.commit()
+
+
+def clear_negative(item_key):
+    """
+    Forgets item_key's failures once it has come back with results.
+    """
+    with _lock:
+        conn = _get_conn()
+        conn.execute("DELETE FROM negative WHERE item_key = ?", (item_key,))
+        conn.commit()
+
+
+def is_suppressed(item_key):
+    with _lock:
+        row = _get_conn().execute("SELECT retry_after FROM negative WHERE item_key = ?", (item_key,)).fetchone()
+    return row is not None and row[0] > time.time()
+
+
+def get_suppressed():
+    """
+    Returns the set of item keys that are currently suppressed.
+    """
+    with _lock:
+        rows = _get_conn().execute("SELECT item_key FROM negative WHERE retry_after > ?", (time.time(),)).fetchall()
+    return {row[0] for row in rows}
+
+
+def get_cache_stats():
+    """
+    Returns hit/miss counters for this process along with the number of stored entries.
+    """
+    with _lock:
+        entries = _get_conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    total = cache_hits + cache_misses
+    return {
+        'hits': cache_hits,
+        'misses': cache_misses,
+        'hit_rate': cache_hits / total if total else 0.0,
+        'entries': entries
+    }
+
+
+def reset_cache_stats():
+    global cache_hits, cache_misses
+    cache_hits = 0
+    cache_misses = 0
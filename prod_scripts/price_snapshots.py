@@ -0,0 +1,200 @@
+import os
+import glob
+import atexit
+import time
+import threading
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+SNAPSHOT_DIR = "snapshots"
+# Buffered rows are written out once there are this many, or once the oldest
+# has waited FLUSH_SECONDS, so each flush makes one reasonably sized file
+FLUSH_ROWS = 20000
+FLUSH_SECONDS = 15 * 60
+# A compaction lock older than this was left by a process that died mid-way
+STALE_LOCK_SECONDS = 60 * 60
+
+SCHEMA = pa.schema([
+    ('fetched_at', pa.timestamp('s', tz='UTC')),
+    ('item_type', pa.string()),
+    ('item_id', pa.string()),
+    ('color_id', pa.int32()),
+    ('condition', pa.string()),
+    ('guide_type', pa.string()),
+    ('country_code', pa.string()),          # country filter the guide was requested with, if any
+    ('seller_country_code', pa.string()),
+    ('buyer_country_code', pa.string()),
+    ('date_ordered', pa.string()),
+    ('quantity', pa.int32()),
+    ('unit_price', pa.float64()),
+    ('shipping_available', pa.bool_()),
+    ('total_quantity', pa.int32()),         # guide-level totals, repeated on every tier
+    ('unit_quantity', pa.int32())
+])
+
+_buffer = []
+_buffer_started = None
+_lock = threading.Lock()
+_files_written = 0
+
+
+def record_snapshot(item_type, item_id, condition, guide_type, country_code, color_id, data):
+    """
+    Buffers every tier of a price guide response as snapshot rows. Guides with
+    no tiers get a single row with empty tier columns so their totals are kept.
+    """
+    fetched_at = datetime.now(timezone.utc).replace(microsecond=0)
+    base = {
+        'fetched_at': fetched_at,
+        'item_type': item_type,
+        'item_id': item_id,
+        'color_id': int(color_id) if color_id else None,
+        'condition': condition,
+        'guide_type': guide_type,
+        'country_code': country_code,
+        'total_quantity': data.get('total_quantity'),
+        'unit_quantity': data.get('unit_quantity')
+    }
+    tiers = data.get('price_detail') or [{}]
+    rows = []
+    for tier in tiers:
+        row = dict(base)
+        row['seller_country_code'] = tier.get('seller_country_code')
+        row['buyer_country_code'] = tier.get('buyer_country_code')
+        row['date_ordered'] = tier.get('date_ordered')
+        row['quantity'] = int(tier['quantity']) if 'quantity' in tier else None
+        row['unit_price'] = float(tier['unit_price']) if 'unit_price' in tier else None
+        row['shipping_available'] = tier.get('shipping_available')
+        rows.append(row)
+    global _buffer_started
+    with _lock:
+        if not _buffer:
+            _buffer_started = time.time()
+        _buffer.extend(rows)
+    flush_if_due()
+
+
+def flush_if_due():
+    """
+    Flushes once FLUSH_ROWS rows are buffered or the oldest has been waiting
+    FLUSH_SECONDS. Called after every batch so a slow scanner still writes
+    its rows out now and then.
+    """
+    with _lock:
+        due = len(_buffer) >= FLUSH_ROWS or (_buffer and time.time() - _buffer_started >= FLUSH_SECONDS)
+    if due:
+        flush()
+
+
+def flush():
+    """
+    Writes buffered rows to Arrow IPC files partitioned by fetch date and item type:
+    snapshots/date=YYYY-MM-DD/item_type=MINIFIG/part-....arrow
+    """
+    global _files_written, _buffer_started
+    with _lock:
+        rows = list(_buffer)
+        _buffer.clear()
+        _buffer_started = None
+        if not rows:
+            return
+        partitions = {}
+        for row in rows:
+            partitions.setdefault((row['fetched_at'].strftime("%Y-%m-%d"), row['item_type']), []).append(row)
+        for (day, item_type), part_rows in partitions.items():
+            directory = os.path.join(SNAPSHOT_DIR, f"date={day}", f"item_type={item_type}")
+            os.makedirs(directory, exist_ok=True)
+            _files_written += 1
+            path = os.path.join(directory, f"part-{datetime.now().strftime('%H%M%S')}-{os.getpid()}-{_files_written}.arrow")
+            _write_file(path, pa.Table.from_pylist(part_rows, schema=SCHEMA))
+
+
+def _write_file(path, table):
+    # written under a temporary name so readers never open a half-written file
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+# Don't lose whatever is still buffered when the process exits
+atexit.register(flush)
+
+
+def compact(day):
+    """
+    Merges the part files of one date partition ("YYYY-MM-DD") into a single
+    file per item type. Meant for past days, which no scanner writes to any
+    more; a partition another process is already compacting is skipped.
+    Returns the number of files merged away.
+    """
+    day_dir = os.path.join(SNAPSHOT_DIR, f"date={day}")
+    lock_path = os.path.join(day_dir, ".compacting")
+    if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+        os.remove(lock_path)
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except (FileExistsError, FileNotFoundError):
+        return 0
+    merged = 0
+    try:
+        for type_dir in sorted(glob.glob(os.path.join(day_dir, "item_type=*"))):
+            paths = sorted(glob.glob(os.path.join(type_dir, "*.arrow")))
+            if len(paths) < 2:
+                continue
+            tables = []
+            for path in paths:
+                with pa.OSFile(path, 'rb') as source:
+                    tables.append(ipc.open_file(source).read_all())
+            compacted_path = os.path.join(type_dir, f"compacted-{int(time.time())}.arrow")
+            _write_file(compacted_path, pa.concat_tables(tables).combine_chunks())
+            for path in paths:
+                if path != compacted_path:
+                    os.remove(path)
+            merged += len(paths) - 1
+    finally:
+        os.remove(lock_path)
+    return merged
+
+
+def compact_past_days():
+    """
+    Compacts every date partition before today (UTC) that has more than one
+    file for an item type.
+    """
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    merged = 0
+    for day_dir in sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "date=*"))):
+        day = os.path.basename(day_dir)[len("date="):]
+        if day < today and any(len(glob.glob(os.path.join(type_dir, "*.arrow"))) > 1
+                               for type_dir in glob.glob(os.path.join(day_dir, "item_type=*"))):
+            merged += compact(day)
+    return merged
+
+
+def read_snapshots(start_date=None, end_date=None, item_types=None, columns=None):
+    """
+    Reads snapshot rows into one pyarrow Table. Only partitions between
+    start_date and end_date ("YYYY-MM-DD", inclusive) and of the given
+    item_types are opened, and files are memory-mapped rather than copied.
+    """
+    tables = []
+    for day_dir in sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "date=*"))):
+        day = os.path.basename(day_dir)[len("date="):]
+        if (start_date and day < start_date) or (end_date and day > end_date):
+            continue
+        for type_dir in sorted(glob.glob(os.path.join(day_dir, "item_type=*"))):
+            if item_types and os.path.basename(type_dir)[len("item_type="):] not in item_types:
+                continue
+            for path in sorted(glob.glob(os.path.join(type_dir, "*.arrow"))):
+                table = ipc.open_file(pa.memory_map(path, 'r')).read_all()
+                tables.append(table.select(columns) if columns else table)
+    if not tables:
+        return SCHEMA.empty_table().select(columns) if columns else SCHEMA.empty_table()
+    return pa.concat_tables(tables)
+
+
+if __name__ == "__main__":
+    print(f"Merged away {compact_past_days()} snapshot files")
@@ -0,0 +1,126 @@
+import sys
+import argparse
+import itertools
+import pandas as pd
+import helper_functions
+from helper_functions import fetch_minifig_bom
+from batch_evaluator import compositions_frame, evaluate_minifigs, evaluate_parts, sort_tiers
+from price_snapshots import read_snapshots
+
+# Parameter values to try; every combination is evaluated
+PARAMETER_GRID = {
+    'discount_rate': [0.5, 0.6, 0.7],
+    'sell_thru_rate': [0.2, 0.4, 0.6],
+    'min_intl_quantity': [1, 2, 5],
+    'min_price': [0.25, 1.0, 5.0]
+}
+PARTS_PARAMETER_GRID = {
+    'discount_rate': [0.5, 0.6, 0.7],
+    'sell_thru_rate_minifig': [0.2, 0.4],
+    'sell_thru_rate_part': [0.1, 0.2],
+    'min_minifig_quantity': [1, 2],
+    'min_minifig_price': [0.25, 1.0]
+}
+
+GUIDE_KEY = ['item_type', 'item_id', 'color_id', 'condition', 'guide_type', 'country_code']
+
+
+def parameter_sets(grid):
+    """
+    Expands a {name: [values]} grid into a list of {name: value} dicts.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def load_latest_guides(start_date=None, end_date=None, item_types=None):
+    """
+    Loads snapshot rows, keeping only the most recent fetch of each price
+    guide, sorted for the evaluators (see batch_evaluator.sort_tiers).
+    """
+    df = read_snapshots(start_date, end_date, item_types).to_pandas()
+    if df.empty:
+        return df
+    df['color_id'] = df['color_id'].astype('Int64')
+    latest = df.groupby(GUIDE_KEY, dropna=False)['fetched_at'].transform('max')
+    return sort_tiers(df[df['fetched_at'] == latest])
+
+
+def _with_params(result, param_sets):
+    """
+    Adds the parameter values each opportunity was found with after its param_set index.
+    """
+    params = pd.DataFrame(param_sets)
+    params['param_set'] = range(len(params))
+    return params.merge(result, on='param_set')[['param_set'] + list(params.columns[:-1]) + list(result.columns[1:])]
+
+
+def replay_minifigs(guides, param_sets):
+    """
+    Evaluates the minifig arbitrage rules for every snapshotted minifig
+    under every parameter set at once. Returns one row per opportunity, tagged
+    with the parameters that produced it.
+    """
+    return _with_params(evaluate_minifigs(guides, param_sets), param_sets)
+
+
+def load_compositions(item_ids):
+    """
+    Reads the stored part lists of the given minifigs without calling the API.
+    Minifigs with no stored composition are left out.
+    """
+    parts_by_item = {}
+    helper_functions.offline = True
+    try:
+        for item_id in item_ids:
+            try:
+                parts_by_item[item_id] = fetch_minifig_bom(item_id)
+            except RuntimeError:
+                continue
+    finally:
+        helper_functions.offline = False
+    return parts_by_item
+
+
+def replay_parts(guides, param_sets):
+    """
+    Evaluates the break/build rules for every snapshotted
+    minifig with a stored composition under every parameter set at once.
+    Minifigs whose parts weren't all snapshotted (e.g. ones only the plain
+    minifig scanner has priced) are left out.
+    """
+    parts_by_item = load_compositions(guides.loc[guides['item_type'] == 'MINIFIG', 'item_id'].unique())
+    part_guides = guides[guides['item_type'] == 'PART']
+    snapshotted = set(zip(part_guides['item_id'], part_guides['color_id']))
+    parts_by_item = {item_id: parts for item_id, parts in parts_by_item.items()
+                     if all((line.part_no, line.color_id) in snapshotted for line in parts)}
+    guides = guides[(guides['item_type'] != 'MINIFIG') | guides['item_id'].isin(list(parts_by_item))]
+    return _with_params(evaluate_parts(guides, compositions_frame(parts_by_item), param_sets), param_sets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay stored price snapshots through the arbitrage rules.")
+    parser.add_argument("-parts", action="store_true", help="replay the break/build parts rules")
+    parser.add_argument("--start", help="first snapshot date to use (YYYY-MM-DD)")
+    parser.add_argument("--end", help="last snapshot date to use (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    if args.parts:
+        guides = load_latest_guides(args.start, args.end, ['MINIFIG', 'PART'])
+        grid = parameter_sets(PARTS_PARAMETER_GRID)
+        result = replay_parts(guides, grid) if not guides.empty else pd.DataFrame()
+        output = "arbitrage/replay_parts_minifig_opportunities.csv"
+    else:
+        guides = load_latest_guides(args.start, args.end, ['MINIFIG'])
+        grid = parameter_sets(PARAMETER_GRID)
+        result = replay_minifigs(guides, grid) if not guides.empty else pd.DataFrame()
+        output = "arbitrage/replay_minifig_opportunities.csv"
+
+    if result.empty:
+        print("No opportunities found in the stored snapshots.")
+        sys.exit(0)
+    result.to_csv(output, index=False)
+    counts = result.groupby('param_set').size()
+    print(f"Replayed {len(grid)} parameter sets, {len(result)} opportunities written to {output}")
+    for param_set, params in enumerate(grid):
+        print(f"  {params}: {counts.get(param_set, 0)} opportunities")
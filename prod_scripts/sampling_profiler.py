@@ -0,0 +1,65 @@
+import sys
+import threading
+from collections import Counter
+
+# Seconds between samples
+SAMPLE_INTERVAL = 0.005
+# Innermost frames kept per stack, so deep pandas stacks don't blow up the output
+MAX_DEPTH = 40
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread (the fetch engine's workers included)
+    every `interval` seconds from a background thread. Far cheaper than
+    cProfile on the hot path, and sleeps and blocking I/O show up as the
+    frames they wait in. Stacks are counted in folded form
+    ("module:function;module:function 12"), which flamegraph tools read.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def top(self, count=15):
+        """
+        The functions most often on top of a stack, as [(function, share of samples)].
+        """
+        leaves = Counter()
+        for stack, hits in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += hits
+        total = sum(leaves.values()) or 1
+        return [(function, hits / total) for function, hits in leaves.most_common(count)]
+
+    def write_folded(self, path):
+        with open(path, "w") as f:
+            for stack, hits in self.stacks.most_common():
+                f.write(f"{stack} {hits}\n")
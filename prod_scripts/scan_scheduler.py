@@ -0,0 +1,184 @@
+import os
+import time
+from sqlite_store import connect
+
+SCHEDULE_FILE = "flags/scan_schedule.db"
+# Value every item gets on top of what its last scan suggests, so items that
+# have never looked promising still come up for a rescan now and then
+BASE_VALUE = 0.25
+# Sell-thru rates above this count the same, so one hot item can't starve the rest
+MAX_SELL_THRU = 2.0
+# Weight of the latest price change in the running volatility estimate
+VOLATILITY_WEIGHT = 0.3
+# Items handed to a batch aren't handed out again for this long, unless the
+# batch records them first or its process exits
+CLAIM_SECONDS = 15 * 60
+
+_conn = None
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = connect(SCHEDULE_FILE, explicit_transactions=True)
+        _conn.execute("""
+            CREATE TABLE IF NOT EXISTS scan_state (
+                workflow TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                last_scanned REAL,
+                claimed_at REAL,
+                claimed_by TEXT,
+                price REAL,
+                sell_thru REAL,
+                spread REAL,
+                volatility REAL NOT NULL DEFAULT 0,
+                scans INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (workflow, item_id)
+            )
+        """)
+    return _conn
+
+
+def _claim_held(claimed_by, claimed_at, now):
+    """
+    True if another live process claimed the item less than CLAIM_SECONDS ago.
+    """
+    if not claimed_at or now - claimed_at >= CLAIM_SECONDS or claimed_by == str(os.getpid()):
+        return False
+    try:
+        os.kill(int(claimed_by), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError, TypeError):
+        pass
+    return True
+
+
+def expected_value(price, sell_thru, spread, volatility):
+    """
+    Rough dollar value of rescanning an item: its price, scaled by how fast it
+    sells and by how far apart US and international prices were last time
+    (or how much its price has been moving).
+    """
+    if not price or not sell_thru:
+        return BASE_VALUE
+    return BASE_VALUE + price * min(sell_thru, MAX_SELL_THRU) * (max(spread or 0, 0) + volatility)
+
+
+def score(state, now):
+    """
+    Scan priority of an item. The expected value accrues for every hour since
+    the last scan, so valuable items are rescanned often and cold items at
+    BASE_VALUE still rise to the top eventually. Never-scanned items come first.
+    """
+    if state is None or state['last_scanned'] is None:
+        return float('inf')
+    age_hours = max(now - state['last_scanned'], 0) / 3600
+    return expected_value(state['price'], state['sell_thru'], state['spread'], state['volatility']) * age_hours
+
+
+def pick_batch(workflow, item_ids, count, steal_ids=()):
+    """
+    Returns the `count` items of item_ids with the highest scan priority for
+    workflow, and claims them so concurrent scanners pick different items.
+    Items that have never been scanned are taken in list order.
+
+    steal_ids are other workers' shards. Their never-scanned items are taken
+    once item_ids has none left, and any of their items fill up the batch if
+    item_ids runs short, so a worker that finishes its shard early helps out.
+    """
+    now = time.time()
+    conn = _get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        states = {}
+        for row in conn.execute(
+            "SELECT item_id, last_scanned, claimed_at, claimed_by, price, sell_thru, spread, volatility "
+            "FROM scan_state WHERE workflow = ?", (workflow,)
+        ):
+            states[row[0]] = dict(zip(('last_scanned', 'claimed_at', 'claimed_by', 'price', 'sell_thru', 'spread', 'volatility'), row[1:]))
+
+        own = dict.fromkeys(item_ids)
+        candidates = []
+        stealable = []
+        for shard, ids in ((0, own), (1, [item_id for item_id in dict.fromkeys(steal_ids) if item_id not in own])):
+            for position, item_id in enumerate(ids):
+                state = states.get(item_id)
+                if state and _claim_held(state['claimed_by'], state['claimed_at'], now):
+                    continue
+                # ties between never-scanned items go to the worker's own shard first
+                candidate = (-score(state, now), shard, position, item_id)
+                (stealable if shard and candidate[0] != float('-inf') else candidates).append(candidate)
+        ranked = sorted(candidates)
+        if len(ranked) < count:
+            ranked += sorted(stealable)
+        batch = [candidate[-1] for candidate in ranked[:count]]
+
+        conn.executemany(
+            "INSERT INTO scan_state (workflow, item_id, claimed_at, claimed_by) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (workflow, item_id) DO UPDATE SET claimed_at = excluded.claimed_at, claimed_by = excluded.claimed_by",
+            [(workflow, item_id, now, str(os.getpid())) for item_id in batch]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return batch
+
+
+def record_scans(workflow, batch_ids, metrics):
+    """
+    Stores what a batch saw and releases its claims.
+
+    :param batch_ids: every item pick_batch handed to the batch
+    :param metrics: {item_id: {'price', 'sell_thru', 'spread'}} for the items
+        actually scanned (see batch_evaluator.item_metrics); values may be None
+    """
+    now = time.time()
+    conn = _get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for item_id, values in metrics.items():
+            row = conn.execute(
+                "SELECT price, volatility FROM scan_state WHERE workflow = ? AND item_id = ?", (workflow, item_id)
+            ).fetchone()
+            old_price, volatility = row if row else (None, 0)
+            price = values.get('price')
+            if old_price and price:
+                change = abs(price - old_price) / old_price
+                volatility = VOLATILITY_WEIGHT * change + (1 - VOLATILITY_WEIGHT) * volatility
+            conn.execute(
+                "INSERT INTO scan_state (workflow, item_id, last_scanned, price, sell_thru, spread, volatility, scans) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (workflow, item_id) DO UPDATE SET last_scanned = excluded.last_scanned, "
+                "price = excluded.price, sell_thru = excluded.sell_thru, spread = excluded.spread, "
+                "volatility = excluded.volatility, scans = scans + 1",
+                (workflow, item_id, now, price, values.get('sell_thru'), values.get('spread'), volatility)
+            )
+        conn.executemany(
+            "UPDATE scan_state SET claimed_at = NULL, claimed_by = NULL WHERE workflow = ? AND item_id = ?",
+            [(workflow, item_id) for item_id in batch_ids]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+if __name__ == "__main__":
+    # Show the next items each workflow would scan
+    import sys
+    from batch_common import load_minifig_ids
+    item_ids = load_minifig_ids(sys.argv)
+    now = time.time()
+    conn = _get_conn()
+    for workflow in ("minifig_opportunities", "parts_minifig_opportunities"):
+        states = {}
+        for row in conn.execute(
+            "SELECT item_id, last_scanned, price, sell_thru, spread, volatility FROM scan_state WHERE workflow = ?",
+            (workflow,)
+        ):
+            states[row[0]] = dict(zip(('last_scanned', 'price', 'sell_thru', 'spread', 'volatility'), row[1:]))
+        ranked = sorted(item_ids, key=lambda item_id: -score(states.get(item_id), now))
+        scanned = sum(1 for item_id in item_ids if item_id in states and states[item_id]['last_scanned'])
+        print(f"{workflow}: {scanned} of {len(item_ids)} minifigs scanned so far, next up: {', '.join(ranked[:10])}")
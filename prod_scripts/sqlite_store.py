@@ -0,0 +1,24 @@
+import os
+import sqlite3
+
+# Seconds a connection waits for another process's write lock before giving up
+BUSY_TIMEOUT = 30
+
+
+def connect(path, explicit_transactions=False, threaded=False):
+    """
+    Opens the SQLite file at path, creating its directory first, in WAL mode
+    so readers in other scanner processes don't block the writer. Every
+    process opens its own connection (see run_minifigs.run_coordinator).
+
+    explicit_transactions sets isolation_level=None, so the caller controls
+    transactions itself; it uses BEGIN IMMEDIATE to take the write lock up
+    front, which keeps read-then-write updates atomic across processes.
+    threaded allows the connection to be used from the fetch engine's
+    worker threads. The caller then serializes access with its own lock.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None if explicit_transactions else "",
+                           check_same_thread=not threaded)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
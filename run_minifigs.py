@@ -1,53 +1,138 @@
-import subprocess
 import time
 import os
 import sys
-from datetime import datetime
+import signal
+import multiprocessing
 
-FLAG_FILE = "flags/api_call_count.txt"
-API_LIMIT = 5000
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "prod_scripts"))
+import minifig_batch
+import minifig_parts_batch
+from batch_common import select_category, load_minifig_ids, save_opportunities, shard_ids
+from bricklink_client import get_default_client
+from helper_functions import get_api_call_count
+from price_cache import get_cache_stats
+from opportunity_store import export_csv
+from price_snapshots import compact_past_days
+from call_metrics import configure as configure_metrics
+
+# The opportunities CSV is re-exported from the store at most this often
+EXPORT_SECONDS = 10 * 60
+# Pause after a batch answered entirely from the price cache, so a scanner with
+# nothing new to fetch doesn't spin through cached guides
+IDLE_SECONDS = 60
+# Wait after a batch fails (e.g. the API is unreachable), doubling with each
+# failure in a row up to MAX_ERROR_BACKOFF_SECONDS
+ERROR_BACKOFF_SECONDS = 30
+MAX_ERROR_BACKOFF_SECONDS = 15 * 60
+
+stop_requested = False
+
+def request_stop(signum, frame):
+    """Finish the current batch, save its opportunities, then exit."""
+    global stop_requested
+    print(f"Received signal {signum}, stopping after the current batch...")
+    stop_requested = True
 
 def api_limit_hit_today():
-    """Check if the API limit has already been hit today or will be exceeded by next batch."""
-    today = datetime.now().strftime("%Y-%m-%d")
-    if not os.path.exists(FLAG_FILE):
-        return False
+    """Check if today's API budget in the shared ledger is used up."""
+    return get_default_client().remaining_today() <= 0
+
+def sleep_unless_stopped(seconds):
+    """Sleep for up to seconds, waking early if a stop was requested."""
+    until = time.time() + seconds
+    while not stop_requested and time.time() < until:
+        time.sleep(1)
+
+def run_scanner(parts_flag, shard=None, steal_ids=(), export=True):
+    """
+    Scans the catalog batch after batch in this process, keeping the minifig
+    list, price cache and HTTP connection pool warm between batches.
+    A worker started by run_coordinator scans its shard, may take over
+    steal_ids, and leaves exporting the CSV to the coordinator.
+    """
+    batch_module = minifig_parts_batch if parts_flag else minifig_batch
+    configure_metrics(sys.argv)
+    client = get_default_client()
+    category = select_category(sys.argv)
+    minifig_ids = shard if shard is not None else load_minifig_ids(sys.argv)
+    print(f"Loaded {len(minifig_ids)} minifigs ({category}) from the catalog")
+
+    last_export = time.time()
+    failures = 0
     try:
-        with open(FLAG_FILE, "r") as f:
-            lines = f.readlines()
-        file_date = lines[0].strip() if len(lines) > 0 else ""
-        file_count = int(lines[1].strip()) if len(lines) > 1 and lines[1].strip().isdigit() else 0
-    except Exception:
-        file_date = ""
-        file_count = 0
-
-    # If today's date and count + estimated calls exceeds API_LIMIT, treat as limit hit
-    if file_date == today:
-        # Check if parts flag is in sys.argv (parts workflow)
-        if "-parts" in sys.argv:
-            parts_calls_per_run = 2000  # Conservative estimate for parts workflow (variable calls)
-            if file_count + parts_calls_per_run > API_LIMIT:
-                return True
-        else:
-            minifig_calls_per_run = 800  # Original estimate for regular minifigs
-            if file_count + minifig_calls_per_run > API_LIMIT:
-                return True
-    return False
-
-def run_main_script(sw_flag, sh_flag, col_flag, parts_flag):
-    """Run the main arbitrage script once, optionally with -sw or -sh."""
-    if parts_flag:
-        cmd = ["python3", "prod_scripts/minifig_parts_batch.py"]
-    else:       
-        cmd = ["python3", "prod_scripts/minifig_batch.py"]
-    if sw_flag:
-        cmd.append("-sw")
-    elif sh_flag:
-        cmd.append("-sh")
-    elif col_flag:
-        cmd.append("-col")
-    result = subprocess.run(cmd)
-    return result.returncode == 0
+        while not stop_requested and not api_limit_hit_today():
+            print("Running arbitrage batch...")
+            try:
+                arbitrage_data, api_limit_hit = batch_module.scan_batch(minifig_ids, client, category=category,
+                                                                        steal_ids=steal_ids)
+            except Exception as e:
+                failures += 1
+                backoff = min(ERROR_BACKOFF_SECONDS * 2 ** (failures - 1), MAX_ERROR_BACKOFF_SECONDS)
+                print(f"Batch failed: {e!r}. Retrying in {backoff}s")
+                sleep_unless_stopped(backoff)
+                continue
+            failures = 0
+            # Saved straight away: the schedule already counts these minifigs as scanned
+            save_opportunities(arbitrage_data, batch_module.TABLE)
+            if api_limit_hit:
+                break
+            if get_api_call_count() == 0:
+                print(f"Everything in this batch was cached; waiting {IDLE_SECONDS}s")
+                sleep_unless_stopped(IDLE_SECONDS)
+            if export and time.time() - last_export >= EXPORT_SECONDS:
+                export_csv(batch_module.TABLE)
+                last_export = time.time()
+    finally:
+        if export:
+            export_csv(batch_module.TABLE)
+    print(f"API calls today: {client.calls_today()}")
+    cache_stats = get_cache_stats()
+    print(f"Price cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['entries']} entries stored)")
+
+def run_worker(index, parts_flag, shard, steal_ids):
+    """Entry point of a worker process started by run_coordinator."""
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    print(f"Worker {index} (pid {os.getpid()}) starting on {len(shard)} minifigs")
+    run_scanner(parts_flag, shard, steal_ids, export=False)
+
+def run_coordinator(parts_flag, workers, shard_by):
+    """
+    Splits the selected minifigs into one shard per worker process and waits
+    for them. The workers share the price cache, the budget ledger, the rate
+    limiter and the scan schedule through their files in flags/, and take
+    over minifigs from other shards once their own run out. The CSV is
+    exported from here so workers never write it at the same time.
+    """
+    table = (minifig_parts_batch if parts_flag else minifig_batch).TABLE
+    minifig_ids = load_minifig_ids(sys.argv)
+    shards = [shard for shard in shard_ids(minifig_ids, workers, shard_by) if shard]
+    print(f"Sharding {len(minifig_ids)} minifigs by {shard_by} across {len(shards)} workers")
+
+    # spawn rather than fork: the workers must not share this process's SQLite connections
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(index, parts_flag, shard, minifig_ids))
+                 for index, shard in enumerate(shards)]
+    for process in processes:
+        process.start()
+
+    stopping = False
+    last_export = time.time()
+    while any(process.is_alive() for process in processes):
+        for process in processes:
+            process.join(timeout=1)
+        if stop_requested and not stopping:
+            # workers finish their current batch and save it on SIGTERM
+            stopping = True
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        if time.time() - last_export >= EXPORT_SECONDS:
+            export_csv(table)
+            last_export = time.time()
+    export_csv(table)
+    client = get_default_client()
+    print(f"API calls today: {client.calls_today()}")
 
 if __name__ == "__main__":
     sw_flag = "-sw" in sys.argv
@@ -62,14 +147,25 @@ if __name__ == "__main__":
         print("Only doing collectible minifigs")
     if parts_flag:
         print("Considering parts")
-    while not api_limit_hit_today():
-        print("Running arbitrage script...")
-        success = run_main_script(sw_flag, sh_flag, col_flag, parts_flag)
-        if not success:
-            print("Error occurred while running the script. Exiting.")
-            break
-        print("Sleeping before next batch (5 sec)...")
-        time.sleep(5)
+
+    workers = 1
+    shard_by = "range"
+    for arg in sys.argv:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg.startswith("--shard-by="):
+            shard_by = arg.split("=", 1)[1]
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    # Earlier days' snapshots are complete, so their small files can be merged
+    merged = compact_past_days()
+    if merged:
+        print(f"Compacted {merged} snapshot files from earlier days")
+    if workers > 1:
+        run_coordinator(parts_flag, workers, shard_by)
+    else:
+        run_scanner(parts_flag)
 
     if api_limit_hit_today():
         print("API limit hit for today. Exiting.")
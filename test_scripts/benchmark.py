@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import threading
+import contextlib
+import io
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+from mock_bricklink import MockBrickLink
+from bricklink_client import BrickLinkClient
+from call_metrics import configure as configure_metrics
+import minifig_batch
+import minifig_parts_batch
+
+# Scans synthetic minifigs with minifig_batch (or minifig_parts_batch with -parts)
+# against mock_bricklink.py in a scratch directory, so nothing touches the real
+# flags/ files or the API, and reports throughput, calls, latency and memory.
+#
+#   python test_scripts/benchmark.py -parts --items=100 --latency=0.1 --error-rate=0.02
+#   python test_scripts/benchmark.py --save=base.json      (then --baseline=base.json after a change)
+#
+# --rate=N overrides REQUESTS_PER_SECOND to see what the scanner does without the rate limit.
+
+ITEMS = 100
+BATCH_SIZE = 25
+
+
+class TimedClient(BrickLinkClient):
+    """
+    BrickLinkClient that records how long every request took, retries included.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self._latency_lock = threading.Lock()
+
+    def get(self, path, params=None):
+        started = time.perf_counter()
+        try:
+            return super().get(path, params=params)
+        finally:
+            with self._latency_lock:
+                self.latencies.append(time.perf_counter() - started)
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def run_benchmark(parts_flag, items, batch_size, rate, quiet, settings):
+    """
+    Scans `items` never-seen minifigs in batches of batch_size and returns the results as a dict.
+    """
+    batch_module = minifig_parts_batch if parts_flag else minifig_batch
+    server = MockBrickLink(**settings)
+    server.start()
+    client = TimedClient("bench", "bench", "bench", "bench", base_url=server.url)
+    if rate:
+        client.rate_limiter.rate = client.rate_limiter.capacity = rate
+    minifig_ids = [f"sw{i:04d}" for i in range(items)]
+
+    started = time.time()
+    batches = 0
+    while batches * batch_size < items:
+        output = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            batch_module.scan_batch(minifig_ids, client, batch_size=batch_size)
+        batches += 1
+    elapsed = time.time() - started
+    server.shutdown()
+    # from the ledger, so retries are counted too
+    calls = client.calls_today()
+
+    statuses = {}
+    for _, status, _, _ in server.requests:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'workload': 'parts' if parts_flag else 'minifigs',
+        'items': items,
+        'batches': batches,
+        'seconds': round(elapsed, 2),
+        'items_per_sec': round(items / elapsed, 2),
+        'calls': calls,
+        'calls_per_item': round(calls / items, 2),
+        'http_requests': len(server.requests),
+        'statuses': statuses,
+        'response_mb': round(sum(size for _, _, size, _ in server.requests) / 1e6, 2),
+        'p50_ms': round(percentile(client.latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(client.latencies, 0.99) * 1000, 1),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(result, baseline=None):
+    for name, value in result.items():
+        line = f"{name:>16}: {value}"
+        if baseline and isinstance(value, (int, float)) and baseline.get(name):
+            line += f"  ({(value - baseline[name]) / baseline[name] * 100:+.1f}% vs baseline)"
+        print(line)
+
+
+if __name__ == "__main__":
+    parts_flag = "-parts" in sys.argv
+    quiet = "-v" not in sys.argv
+    items = ITEMS
+    batch_size = BATCH_SIZE
+    rate = None
+    save_file = baseline_file = None
+    settings = {}
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition("=")
+        if name == "--items":
+            items = int(value)
+        elif name == "--batch-size":
+            batch_size = int(value)
+        elif name == "--rate":
+            rate = float(value)
+        elif name == "--save":
+            save_file = os.path.abspath(value)
+        elif name == "--baseline":
+            baseline_file = os.path.abspath(value)
+        elif name == "--recorded":
+            settings['recorded'] = os.path.abspath(value)
+        elif name == "--max-rps":
+            settings['max_rps'] = int(value)
+        elif name in ("--latency", "--jitter", "--error-rate", "--throttle-rate", "--retry-after", "--missing-rate"):
+            settings[name[2:].replace("-", "_")] = float(value)
+
+    configure_metrics(sys.argv)
+    # The scanners keep their state in relative paths (flags/, snapshots/,
+    # processed_data/), so run them in a scratch directory that starts empty
+    scratch = tempfile.mkdtemp(prefix="bricklink_benchmark_")
+    os.chdir(scratch)
+    print(f"Benchmarking in {scratch}")
+    result = run_benchmark(parts_flag, items, batch_size, rate, quiet, settings)
+
+    baseline = None
+    if baseline_file:
+        with open(baseline_file, "r") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if save_file:
+        with open(save_file, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved results to {save_file}")
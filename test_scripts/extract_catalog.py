@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Extract minifig lists from BrickLink's catalog download in a single pass.
+
+Streams raw_data/Minifigures.xml item by item, so memory stays flat however big
+the catalog is, and writes every category CSV at once:
+    processed_data/all_minifigs.csv
+    processed_data/star_wars_minifigs.csv
+    processed_data/super_hero_minifigs.csv
+    processed_data/collectible_minifigs.csv
+along with the catalog store (processed_data/catalog.db) the batch scripts
+select minifigs from.
+
+Extra lists can be added in catalog_filters.json in the main folder, e.g.
+    [{"file": "processed_data/ninjago_minifigs.csv", "prefixes": ["njo"]},
+     {"file": "processed_data/castle_minifigs.csv", "categories": ["65"]}]
+Each filter takes "prefixes", "exclude_prefixes" (item_id prefixes, any case)
+and "categories" (category ids); left out means no restriction.
+
+If the XML and the filters are unchanged since the last run, nothing is
+rewritten. Pass -force to extract anyway.
+"""
+
+import os
+import sys
+import csv
+import json
+import hashlib
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+import catalog_store
+
+XML_FILE = 'raw_data/Minifigures.xml'
+CUSTOM_FILTERS_FILE = 'catalog_filters.json'
+STATE_FILE = 'flags/catalog_extract.json'
+COLUMNS = ['item_id', 'item_name', 'category']
+
+FILTERS = [
+    {'file': 'processed_data/all_minifigs.csv'},
+    {'file': 'processed_data/star_wars_minifigs.csv', 'prefixes': ['sw']},
+    {'file': 'processed_data/super_hero_minifigs.csv', 'prefixes': ['sh'], 'exclude_prefixes': ['shell']},
+    {'file': 'processed_data/collectible_minifigs.csv', 'prefixes': ['col']}
+]
+
+
+def load_filters():
+    filters = list(FILTERS)
+    if os.path.exists(CUSTOM_FILTERS_FILE):
+        with open(CUSTOM_FILTERS_FILE, 'r') as f:
+            filters.extend(json.load(f))
+    return filters
+
+
+def matches(item_filter, item_id, category):
+    item_id = item_id.lower()
+    prefixes = item_filter.get('prefixes')
+    if prefixes and not any(item_id.startswith(prefix.lower()) for prefix in prefixes):
+        return False
+    if any(item_id.startswith(prefix.lower()) for prefix in item_filter.get('exclude_prefixes', [])):
+        return False
+    categories = item_filter.get('categories')
+    if categories and category not in [str(c) for c in categories]:
+        return False
+    return True
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def iter_minifigs(path):
+    """
+    Yields (item_id, item_name, category) for every minifig in the catalog XML,
+    clearing each ITEM once it has been read so the tree never builds up.
+    """
+    root = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end' or elem.tag != 'ITEM':
+            continue
+        if elem.findtext('ITEMTYPE') == 'M':
+            yield elem.findtext('ITEMID'), elem.findtext('ITEMNAME'), elem.findtext('CATEGORY')
+        root.clear()
+
+
+def extract(filters):
+    """
+    Writes every filter's CSV in one pass over the XML. Files are written
+    under temporary names and only moved into place once all are complete.
+    Returns the number of rows written per file.
+    """
+    handles = []
+    for item_filter in filters:
+        os.makedirs(os.path.dirname(item_filter['file']) or '.', exist_ok=True)
+        f = open(item_filter['file'] + '.tmp', 'w', newline='')
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        handles.append((item_filter, f, writer))
+
+    counts = {item_filter['file']: 0 for item_filter in filters}
+
+    def rows():
+        for item_id, item_name, category in iter_minifigs(XML_FILE):
+            for item_filter, _, writer in handles:
+                if matches(item_filter, item_id or '', category):
+                    writer.writerow([item_id, item_name, category])
+                    counts[item_filter['file']] += 1
+            yield item_id, item_name, category
+
+    try:
+        # the catalog store is filled from the same pass
+        counts[catalog_store.STORE_FILE] = catalog_store.replace_items(rows())
+    finally:
+        for _, f, _ in handles:
+            f.close()
+
+    for item_filter in filters:
+        os.replace(item_filter['file'] + '.tmp', item_filter['file'])
+    return counts
+
+
+if __name__ == '__main__':
+    filters = load_filters()
+    # The XML's hash plus the filters decide whether the outputs are still current
+    fingerprint = hashlib.sha256((file_hash(XML_FILE) + json.dumps(filters, sort_keys=True)).encode()).hexdigest()
+
+    state = {}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+    outputs = [item_filter['file'] for item_filter in filters] + [catalog_store.STORE_FILE]
+    up_to_date = state.get('fingerprint') == fingerprint and all(os.path.exists(path) for path in outputs)
+    if up_to_date and '-force' not in sys.argv:
+        print(f"{XML_FILE} and the filters are unchanged since the last run; nothing to do.")
+        sys.exit(0)
+
+    counts = extract(filters)
+    for path, count in counts.items():
+        print(f"Extracted {count} minifigs to {path}")
+
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'counts': counts}, f)
@@ -1,24 +1,14 @@
-import requests
-from requests_oauthlib import OAuth1
-import time
 import os
-from dotenv import load_dotenv
-load_dotenv()
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+from bricklink_client import get_default_client
 
-auth = OAuth1(
-    os.getenv("BRICKLINK_CONSUMER_KEY"),
-    os.getenv("BRICKLINK_CONSUMER_SECRET"),
-    os.getenv("BRICKLINK_TOKEN_VALUE"),
-    os.getenv("BRICKLINK_TOKEN_SECRET")
-)
+client = get_default_client()
 
 minifig_ids = ["sw0002"]
 
-BASE_URL = 'https://api.bricklink.com/api/store/v1'
-
 def get_minifig_data(minifig_id):
-    url = f'{BASE_URL}/items/MINIFIG/{minifig_id}'
-    response = requests.get(url, auth=auth)
+    response = client.get(f'/items/MINIFIG/{minifig_id}')
     if response.status_code == 200:
         return response.json()["data"]
     else:
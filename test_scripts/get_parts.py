@@ -1,20 +1,11 @@
 import os
+import sys
 import time
-import requests
-from requests_oauthlib import OAuth1
-from dotenv import load_dotenv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+from bricklink_client import get_default_client
 
-load_dotenv()
+client = get_default_client()
 
-# OAuth1 credentials
-auth = OAuth1(
-    os.getenv("BRICKLINK_CONSUMER_KEY"),
-    os.getenv("BRICKLINK_CONSUMER_SECRET"),
-    os.getenv("BRICKLINK_TOKEN_VALUE"),
-    os.getenv("BRICKLINK_TOKEN_SECRET")
-)
-
-BASE_URL = 'https://api.bricklink.com/api/store/v1'
 minifig_ids = ["sw0239"]
 
 
@@ -23,9 +14,8 @@ def get_minifig_parts(minifig_id):
     """
     Fetch and flatten the parts entries for the given minifigure.
     """
-    url = f"{BASE_URL}/items/MINIFIG/{minifig_id}/subsets"
     params = {"break_minifigs": "true"}
-    resp = requests.get(url, auth=auth, params=params)
+    resp = client.get(f"/items/MINIFIG/{minifig_id}/subsets", params=params)
     if resp.status_code != 200:
         print(f"Error fetching parts for {minifig_id}: HTTP {resp.status_code}")
         return []
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import random
+import sqlite3
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+from price_cache import make_key
+
+# Local stand-in for the BrickLink store API's price guide and subsets endpoints,
+# so the scanners can be run and benchmarked without spending real API calls.
+# Point a scanner at it with BRICKLINK_BASE_URL=http://127.0.0.1:8765 (any keys work).
+
+DEFAULT_SETTINGS = {
+    'latency': 0.05,        # seconds added to every response
+    'jitter': 0.02,         # up to this much more, at random
+    'error_rate': 0.0,      # share of requests answered with a 503
+    'throttle_rate': 0.0,   # share of requests answered with a 429
+    'max_rps': None,        # requests per second served before answering 429
+    'retry_after': 1,       # Retry-After seconds sent with every 429
+    'missing_rate': 0.02,   # share of minifigs that don't exist (404)
+    'recorded': None,       # price_cache.db to serve recorded responses from
+}
+# Synthetic minifigs are built from this many distinct parts, so parts are shared between minifigs
+PART_POOL = 300
+COUNTRIES = ['US', 'US', 'DE', 'GB', 'NL', 'CA']
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; without this each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        started = time.time()
+        settings = self.server.settings
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, body, headers = self.server.respond(url.path, params)
+        delay = settings['latency'] + random.uniform(0, settings['jitter'])
+        time.sleep(max(0, delay - (time.time() - started)))
+
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.log(url.path, status, len(payload), time.time() - started)
+
+
+class MockBrickLink(ThreadingHTTPServer):
+    """
+    Serves /items/{type}/{no}/price and /items/{type}/{no}/subsets with
+    recorded responses from a price cache where there are any, else with
+    synthetic ones that are the same for the same request every time.
+    Keeps a log of (path, status, bytes, seconds) for every request served.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, **settings):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.requests = []
+        self.lock = threading.Lock()
+        self._second = 0
+        self._served_this_second = 0
+        self._recorded = None
+        if self.settings['recorded']:
+            self._recorded = sqlite3.connect(f"file:{self.settings['recorded']}?mode=ro", uri=True,
+                                             check_same_thread=False)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+    def log(self, path, status, size, seconds):
+        with self.lock:
+            self.requests.append((path, status, size, seconds))
+
+    def _throttled(self):
+        with self.lock:
+            now = int(time.time())
+            if now != self._second:
+                self._second, self._served_this_second = now, 0
+            self._served_this_second += 1
+            over_limit = self.settings['max_rps'] and self._served_this_second > self.settings['max_rps']
+        return over_limit or random.random() < self.settings['throttle_rate']
+
+    def respond(self, path, params):
+        """
+        Returns (status, body, headers) for one request.
+        """
+        if self._throttled():
+            return 429, {'meta': {'code': 429, 'message': 'TOO_MANY_REQUESTS'}}, {'Retry-After': str(int(self.settings['retry_after']))}
+        if random.random() < self.settings['error_rate']:
+            return 503, {'meta': {'code': 503}}, {}
+
+        parts = path.rstrip('/').split('/')
+        if len(parts) < 4 or parts[-4] != 'items' or parts[-1] not in ('price', 'subsets'):
+            return 404, {'meta': {'code': 404}}, {}
+        item_type, item_id, endpoint = parts[-3], parts[-2], parts[-1]
+        if item_type == 'MINIFIG' and random.Random(f"missing {item_id}").random() < self.settings['missing_rate']:
+            return 404, {'meta': {'code': 404, 'message': 'RESOURCE_NOT_FOUND'}}, {}
+
+        if endpoint == 'subsets':
+            data = self._recorded_data(make_key('MINIFIG', item_id, None, 'subsets'))
+            if data is None:
+                data = synthetic_subsets(item_id)
+        else:
+            data = self._recorded_data(make_key(item_type, item_id, params.get('new_or_used'), params.get('guide_type'),
+                                                params.get('country_code'), params.get('color_id')))
+            if data is None:
+                data = synthetic_price_guide(item_type, item_id, params)
+        return 200, {'meta': {'code': 200, 'message': 'OK'}, 'data': data}, {}
+
+    def _recorded_data(self, key):
+        if self._recorded is None:
+            return None
+        with self.lock:
+            row = self._recorded.execute("SELECT data FROM responses WHERE cache_key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def synthetic_subsets(item_id):
+    """
+    A made-up composition of 3 to 6 parts in one of a few colours.
+    """
+    rnd = random.Random(f"subsets {item_id}")
+    return [{'match_no': position,
+             'entries': [{'item': {'no': f"{rnd.randrange(PART_POOL)}p", 'type': 'PART'},
+                          'color_id': rnd.choice([1, 5, 11, 86]),
+                          'quantity': 1 if rnd.random() < 0.9 else 2}]}
+            for position in range(rnd.randint(3, 6))]
+
+
+def synthetic_price_guide(item_type, item_id, params):
+    """
+    A made-up price guide. Stock guides list up to 30 lots, and those with
+    more than 25 say more exist so they come back truncated. Sold guides list
+    up to 20 sales. Filtering by country drops the other sellers.
+    """
+    condition = params.get('new_or_used')
+    guide_type = params.get('guide_type', 'stock')
+    country = params.get('country_code')
+    rnd = random.Random(f"{item_type} {item_id} {condition} {guide_type} {params.get('color_id')}")
+    base_price = rnd.uniform(0.05, 3) if item_type == 'PART' else rnd.uniform(1, 60)
+    lots = rnd.randint(0, 30 if guide_type == 'stock' else 20)
+    unit_quantity = lots + (rnd.randint(1, 20) if guide_type == 'stock' and lots > 25 else 0)
+
+    price_detail = []
+    for _ in range(lots):
+        seller_country = rnd.choice(COUNTRIES)
+        tier = {'quantity': rnd.randint(1, 5),
+                'unit_price': f"{base_price * rnd.uniform(0.6, 2.5):.4f}",
+                'shipping_available': rnd.random() < 0.9,
+                'seller_country_code': seller_country}
+        if country and seller_country != country:
+            continue
+        price_detail.append(tier)
+    if country:
+        unit_quantity = len(price_detail)
+    return {'item': {'no': item_id, 'type': item_type},
+            'new_or_used': condition,
+            'currency_code': 'USD',
+            'unit_quantity': unit_quantity,
+            'total_quantity': sum(tier['quantity'] for tier in price_detail),
+            'price_detail': price_detail}
+
+
+if __name__ == "__main__":
+    port = 8765
+    settings = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith("--port="):
+            port = int(arg.split("=", 1)[1])
+        elif arg.startswith("--recorded="):
+            settings['recorded'] = arg.split("=", 1)[1]
+        elif arg.startswith("--max-rps="):
+            settings['max_rps'] = int(arg.split("=", 1)[1])
+        elif arg.startswith("--") and arg[2:].split("=", 1)[0].replace("-", "_") in DEFAULT_SETTINGS:
+            name, value = arg[2:].split("=", 1)
+            settings[name.replace("-", "_")] = float(value)
+    server = MockBrickLink(port, **settings)
+    print(f"Mock BrickLink API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
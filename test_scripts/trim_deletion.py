@@ -1,97 +1,190 @@
 #!/usr/bin/env python3
 """
-Filter out BrickLink items marked for deletion, writing results in batches of 100.
+Filter out BrickLink items marked for deletion.
 
-Assumes your CSV is named 'items.csv' with columns:
+Reads processed_data/all_minifigs.csv (INPUT_CSV), with columns:
     item_id,item_name,category
 
+Catalog pages are checked a few at a time over one shared connection pool,
+and each verdict is recorded in flags/deletion_verdicts.db as soon as it
+comes in. An interrupted run picks up
+where it left off, and later runs only recheck items that are new or whose
+verdict has expired. The filtered CSV is rewritten from the verdicts at the end.
+
 Installs needed:
-    pip install pandas requests beautifulsoup4
+    pip install pandas requests
 """
 
 import os
+import sys
+import codecs
 import time
+from typing import Optional
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prod_scripts'))
+from fetch_engine import TokenBucket
+from catalog_store import set_deleted
+from sqlite_store import connect
 
 INPUT_CSV = 'processed_data/all_minifigs.csv'
 OUTPUT_CSV = 'processed_data/all_minifigs_filtered.csv'
-BATCH_SIZE = 100
+VERDICT_DB = 'flags/deletion_verdicts.db'
 
 # Adjust this if you're also checking PARTs, SETs, etc.
 ITEM_TYPE_PREFIX = 'M'
+CATALOG_URL = os.getenv('BRICKLINK_CATALOG_URL', 'https://www.bricklink.com/v2/catalog/catalogitem.page')
+
+# Politeness limit: pages fetched at once and pages started per second
+MAX_WORKERS = 4
+PAGES_PER_SECOND = 5
+
+# How long a verdict is trusted before the item is checked again
+KEEP_TTL = 30 * 24 * 60 * 60
+DELETED_TTL = 180 * 24 * 60 * 60
 
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (compatible; ArbitrageBot/1.0)'
 }
 
-def is_marked_for_deletion(item_id: str) -> bool:
+# The exact phrase BrickLink uses at the top of deleted items
+DELETION_PHRASE = 'this catalog item is marked for deletion'
+# Bytes of a page fed to the parser at a time
+CHUNK_SIZE = 16384
+
+rate_limiter = TokenBucket(PAGES_PER_SECOND, capacity=1)
+
+# One Session shared by every worker, as BrickLinkClient does: its connection
+# pool is thread-safe and sized for MAX_WORKERS, and nothing changes the
+# session's settings once the workers have started
+session = requests.Session()
+session.headers.update(HEADERS)
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+
+class BannerParser(HTMLParser):
+    """
+    Looks for DELETION_PHRASE in a page's text as it is fed, without building
+    a DOM. Text is matched the way a browser shows it: tags between the words
+    and line breaks or repeated spaces don't matter, and scripts and styles
+    are skipped. Only a whitespace-collapsed tail of the text seen so far is
+    kept, long enough for a phrase split across tags or chunks to match.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found = False
+        self._tail = ''
+        self._hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._hidden += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._hidden:
+            self._hidden -= 1
+
+    def handle_data(self, data):
+        if self.found or self._hidden:
+            return
+        text = ' '.join(f'{self._tail} {data}'.lower().split())
+        self.found = DELETION_PHRASE in text
+        self._tail = text[-len(DELETION_PHRASE):]
+
+
+def is_marked_for_deletion(item_id: str) -> Optional[bool]:
     """
     Returns True if the BrickLink catalog page for this item
-    contains the deletion banner text.
+    contains the deletion banner text. The page is parsed as it streams in,
+    and the download stops as soon as the banner is found.
+    Returns None if the page couldn't be fetched.
     """
-    url = (
-        f'https://www.bricklink.com/v2/catalog/catalogitem.page'
-        f'?{ITEM_TYPE_PREFIX}={item_id}'
-    )
-    resp = requests.get(url, headers=HEADERS, timeout=10)
-    if resp.status_code != 200:
-        print(f'  [!] HTTP {resp.status_code} for {item_id}; keeping by default')
-        return False
-
-    page_text = BeautifulSoup(resp.text, 'html.parser')\
-                    .get_text(separator=' ')\
-                    .lower()
-    # Look for the exact phrase BrickLink uses at the top of deleted items
-    return 'this catalog item is marked for deletion' in page_text
+    rate_limiter.acquire()
+    with session.get(CATALOG_URL, params={ITEM_TYPE_PREFIX: item_id}, timeout=10, stream=True) as resp:
+        if resp.status_code != 200:
+            print(f'  [!] HTTP {resp.status_code} for {item_id}; keeping by default')
+            return None
+        parser = BannerParser()
+        decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            parser.feed(decoder.decode(chunk))
+            if parser.found:
+                return True
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+        return parser.found
+
+
+def _open_verdicts():
+    conn = connect(VERDICT_DB)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS verdicts (
+            item_id TEXT PRIMARY KEY,
+            deleted INTEGER NOT NULL,
+            checked_at REAL NOT NULL
+        )
+    """)
+    conn.commit()
+    return conn
 
-def main():
-    # Remove existing output so we start fresh
-    if os.path.exists(OUTPUT_CSV):
-        os.remove(OUTPUT_CSV)
 
+def _fresh_verdicts(conn):
+    """
+    Returns {item_id: deleted} for every verdict that hasn't expired yet.
+    """
+    now = time.time()
+    verdicts = {}
+    for item_id, deleted, checked_at in conn.execute("SELECT item_id, deleted, checked_at FROM verdicts"):
+        if now - checked_at < (DELETED_TTL if deleted else KEEP_TTL):
+            verdicts[item_id] = bool(deleted)
+    return verdicts
+
+
+def main():
     df = pd.read_csv(INPUT_CSV, dtype=str)
-    buffer = []
-    write_header = True
-
-    print(f'Checking {len(df)} items for deletion…')
-    for idx, row in df.iterrows():
-        item_id = row['item_id']
-        print(f'[{idx+1}/{len(df)}] {item_id}…', end=' ')
-        try:
-            if is_marked_for_deletion(item_id):
-                print('💀 removed')
-            else:
-                print('✅ keep')
-                buffer.append(row)
-        except Exception as e:
-            print(f'(!) error: {e}; keeping')
-            buffer.append(row)
-
-        # If buffer hits batch size, write it out
-        if len(buffer) >= BATCH_SIZE:
-            batch_df = pd.DataFrame(buffer, columns=df.columns)
-            batch_df.to_csv(
-                OUTPUT_CSV,
-                mode='a',
-                index=False,
-                header=write_header
+    conn = _open_verdicts()
+    verdicts = _fresh_verdicts(conn)
+    to_check = [item_id for item_id in dict.fromkeys(df['item_id']) if item_id not in verdicts]
+
+    print(f'{len(df)} items, {len(df) - len(to_check)} with a recent verdict. Checking {len(to_check)} for deletion…')
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = {pool.submit(is_marked_for_deletion, item_id): item_id for item_id in to_check}
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            item_id = futures[future]
+            try:
+                deleted = future.result()
+            except Exception as e:
+                print(f'[{done}/{len(to_check)}] {item_id}… (!) error: {e}; keeping')
+                continue
+            if deleted is None:
+                # no verdict, so it is checked again next run
+                continue
+            print(f'[{done}/{len(to_check)}] {item_id}… {"💀 removed" if deleted else "✅ keep"}')
+            verdicts[item_id] = deleted
+            # journal each verdict right away so a crash loses nothing already checked
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts (item_id, deleted, checked_at) VALUES (?, ?, ?)",
+                (item_id, int(deleted), time.time())
             )
-            write_header = False
-            buffer.clear()
-
-        time.sleep(0.2)  # polite throttle
-
-    # Write any remaining rows
-    if buffer:
-        batch_df = pd.DataFrame(buffer, columns=df.columns)
-        batch_df.to_csv(
-            OUTPUT_CSV,
-            mode='a',
-            index=False,
-            header=write_header
-        )
+            conn.commit()
+    finally:
+        # on Ctrl-C don't wait for the queued pages; the journal already has every finished verdict
+        pool.shutdown(wait=False, cancel_futures=True)
+    conn.close()
+
+    # Items without a verdict (errors) are kept by default
+    kept = df[~df['item_id'].map(lambda item_id: verdicts.get(item_id, False))]
+    tmp_csv = OUTPUT_CSV + '.tmp'
+    kept.to_csv(tmp_csv, index=False)
+    os.replace(tmp_csv, OUTPUT_CSV)
+    # the batch scripts skip deleted items through the catalog store
+    set_deleted(verdicts)
 
     print(f'\nDone. Filtered file written to {OUTPUT_CSV}')
 